@@ -3,6 +3,7 @@ import argparse, sys
 from datetime import datetime, timedelta
 
 from lib.scheduler import Scheduler
+from lib.channels import get_channel
 import config
 from lib.vars import *
 from lib.common import Logger, add_logger_args, get_logger_from_args
@@ -20,6 +21,16 @@ if __name__ == "__main__":
 		help="Date for which to build the schedule. (YYYYMMDD)",
 		type=str
 	)
+	parser.add_argument(
+		"--days",
+		help="Keep the schedule filled DAYS days ahead, creating any missing days. Only useful with --create-schedule",
+		type=int
+	)
+	parser.add_argument(
+		"--channel",
+		help="Only schedule or adjust channel CHANNEL (id). All channels by default",
+		type=int
+	)
 	parser.add_argument(
 		"--xmltv",
 		help="Build xmltv file when done with scheduling",
@@ -35,6 +46,11 @@ if __name__ == "__main__":
 		help="Don't save schedule to DB",
 		action="store_true"
 	)
+	parser.add_argument(
+		"--fix-metadata",
+		help="Refresh titles, descriptions and thumbnails of scheduled items from the library",
+		action="store_true"
+	)
 	parser.add_argument(
 		"--purge",
 		help="Purge schedule keeping ARG days",
@@ -46,17 +62,28 @@ if __name__ == "__main__":
 	logger = get_logger_from_args(args)
 	_print = logger._print
 
+	channel = None
+	if args.channel is not None:
+		channel = get_channel(args.channel)
+		if channel is None:
+			print(f"No channel with id {args.channel}")
+			sys.exit(1)
+
 	scheduler = Scheduler(logger=logger)
 	
 	did_something = False
 	if args.adjust_times:
 		_print("Adjusting times for future schedule items...")
-		scheduler.adjust_schedule_times()
+		scheduler.adjust_schedule_times(channel=channel)
 		_print("Done!")
 		did_something = True
 	
 	if args.create_schedule:
-		if args.date is not None:
+		if args.days is not None:
+			_print(f"Filling schedule {args.days} day(s) ahead...")
+			scheduler.build_schedule_horizon(args.days, dry_run=args.dry_run, channel=channel)
+
+		elif args.date is not None:
 			try:
 				date = datetime.strptime(args.date, "%Y%m%d").date()
 			except:
@@ -65,16 +92,22 @@ if __name__ == "__main__":
 			
 			_print(f"Creating schedule for {args.date}...")
 			if args.dry_run:
-				scheduler.build_schedule(date=date, dry_run=True)
+				scheduler.build_schedule(date=date, dry_run=True, channel=channel)
 			else:
-				scheduler.build_schedule(date=date)
+				scheduler.build_schedule(date=date, channel=channel)
 		
 		else:
 			_print("Creating schedule...")
 			if args.dry_run:
-				scheduler.build_schedule(dry_run=True)
+				scheduler.build_schedule(dry_run=True, channel=channel)
 			else:
-				scheduler.build_schedule()
+				scheduler.build_schedule(channel=channel)
+		_print("Done!")
+		did_something = True
+
+	if args.fix_metadata:
+		_print("Refreshing schedule metadata...")
+		scheduler.fix()
 		_print("Done!")
 		did_something = True
 
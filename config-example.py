@@ -18,6 +18,10 @@ INTERMISSION_INTERVAL = 0
 
 TV_SHOW_DIR = "/path/to/tvshows"
 XMLTV_LOCATION = "/path/to/xmltv"
+## Also write XMLTV_LOCATION.gz next to the guide
+XMLTV_GZIP = False
+## Directory for gzipped JSONL archives of purged schedule rows, or None
+SCHEDULE_ARCHIVE_PATH = None
 
 TVDB_API_KEY = ""
 
@@ -27,6 +31,38 @@ MYSQL_HOST = "localhost"
 MYSQL_USER = "dumbietv"
 
 RTMP_POST = 'rtmp://localhost/live/stream'
+## Serve several channels from one library. Each entry takes id, number,
+## name, icon and rtmp_post. When unset CHANNEL_NAME, CHANNEL_NUMBER,
+## CHANNEL_ICON and RTMP_POST describe the only channel, which has id 1
+## CHANNELS = [
+## 	{'id': 1, 'number': "1", 'name': "My Channel", 'icon': '', 'rtmp_post': 'rtmp://localhost/live/one'},
+## 	{'id': 2, 'number': "2", 'name': "My Other Channel", 'icon': '', 'rtmp_post': 'rtmp://localhost/live/two'},
+## ]
+CHANNELS = None
+## Keep one RTMP connection open and feed every item through it instead
+## of reconnecting for each one
+CONTINUOUS_OUTPUT = False
+## MB to read ahead from the start (and seek point) of the next file so a
+## sleeping disk or busy NAS doesn't stall playback. 0 disables it
+PREFETCH_MB = 64
+## 'nvenc', 'libx264' or 'auto' to time a short encode with each one on
+## startup and use the fastest
+ENCODER = 'auto'
+X264_PRESET = 'veryfast'
+## 0 lets ffmpeg decide
+X264_THREADS = 0
+## How many times faster than realtime an encoder has to be to be trusted
+## with the live stream
+ENCODER_REALTIME_MARGIN = 1.5
+## Directory for pre-transcoded episodes (see transcode.py), or None to
+## always encode live
+TRANSCODE_PATH = None
+TRANSCODE_AHEAD_HOURS = 24
+## Number of upcoming schedule items the player keeps in memory
+PLAYER_LOOKAHEAD = 20
 
 MARATHON_CHANCE = 0.15
 MOVIE_CHANCE = 0.6
+## None for uniform show picks, 'runtime' to favour shows with more content
+## or 'recency' to favour shows that haven't aired in a while
+SHOW_WEIGHTING = None
@@ -37,6 +37,11 @@ if __name__ == "__main__":
 		help="Make sure last played episode is correct. Useful if the schedule has been manually edited",
 		action="store_true"
 	)
+	parser.add_argument(
+		"--rebuild-show-stats",
+		help="Recalculate per-show runtime stats from scratch",
+		action="store_true"
+	)
 	parser.add_argument(
 		"--add-new-movies",
 		help="Add movies to the database that have not yet been added",
@@ -91,6 +96,12 @@ if __name__ == "__main__":
 		_print('Done!')
 		did_something = True
 
+	if args.rebuild_show_stats:
+		_print("Rebuilding show stats...")
+		scanner.rebuild_show_stats()
+		_print('Done!')
+		did_something = True
+
 	if args.add_new_movies:
 		_print("Adding new movies...")
 		movie_scanner.add_new_movies()
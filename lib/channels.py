@@ -0,0 +1,35 @@
+import config
+
+class Channel:
+	__slots__ = ('id', 'number', 'name', 'icon', 'rtmp_post')
+
+	def __init__(self, id, number, name, icon=None, rtmp_post=None):
+		self.id = id
+		self.number = str(number)
+		self.name = name
+		self.icon = icon
+		self.rtmp_post = rtmp_post
+
+	def __repr__(self):
+		return f"Channel({self.id} {self.number} {self.name})"
+
+def get_channels():
+	## Single channel installs only set the old CHANNEL_* globals, which
+	## become channel 1
+	channels = getattr(config, 'CHANNELS', None)
+	if channels:
+		return [Channel(**c) for c in channels]
+
+	return [Channel(
+		1,
+		config.CHANNEL_NUMBER,
+		config.CHANNEL_NAME,
+		icon=config.CHANNEL_ICON,
+		rtmp_post=config.RTMP_POST
+	)]
+
+def get_channel(channel_id):
+	for channel in get_channels():
+		if channel.id == channel_id:
+			return channel
+	return None
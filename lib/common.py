@@ -4,6 +4,7 @@ from PIL import Image
 from io import BytesIO
 from datetime import datetime
 import os
+import hashlib
 
 import config
 from lib.vars import *
@@ -16,11 +17,63 @@ def get_mysql_connection():
 		database = config.MYSQL_DB
 	)
 
+def get_media_file_ids(db, paths):
+	paths = list(set(p for p in paths if p))
+	if not paths:
+		return {}
+
+	cur = db.cursor()
+	q = (
+		"INSERT INTO media_files (path) VALUES (%s) "
+		"ON DUPLICATE KEY UPDATE id = id"
+	)
+	cur.executemany(q, [(p, ) for p in paths])
+
+	placeholders = ", ".join(["%s"] * len(paths))
+	q = f"SELECT id, path FROM media_files WHERE path IN ({placeholders})"
+	cur.execute(q, paths)
+	media_file_ids = {path: media_file_id for media_file_id, path in cur.fetchall()}
+	cur.close()
+
+	return media_file_ids
+
+def update_by_id(cur, table, column, values, extra=None):
+	## Single UPDATE setting column to values[id] on every row in values,
+	## plus any extra columns that take the same value on all of them
+	if not values:
+		return 0
+
+	cases = " ".join(["WHEN %s THEN %s"] * len(values))
+	placeholders = ", ".join(["%s"] * len(values))
+	assignments = [f"{column} = CASE id {cases} END"]
+	params = []
+	for row_id, value in values.items():
+		params += [row_id, value]
+	for extra_column, value in (extra or {}).items():
+		assignments.append(f"{extra_column} = %s")
+		params.append(value)
+	params += list(values.keys())
+
+	q = (
+		f"UPDATE {table} "
+		f"SET {', '.join(assignments)} "
+		f"WHERE id IN ({placeholders})"
+	)
+	cur.execute(q, params)
+	return len(values)
+
 def get_image_dimensions(url):
 	data = requests.get(url).content
 	im = Image.open(BytesIO(data))    
 	return im.size
 
+def file_sha256(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024*1024), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
 def add_logger_args(parser):
 	parser.add_argument(
 		"--log-level",
@@ -0,0 +1,173 @@
+import subprocess
+import threading
+import time
+
+from lib.common import Logger
+from lib.vars import *
+import config
+
+_print = Logger()._print
+
+class EncoderBackend:
+	name = None
+	## Name as listed by `ffmpeg -encoders`
+	encoder = None
+	## False for backends that can't run a filter graph
+	encodes = True
+
+	def input_args(self, hw_frames=False):
+		return []
+
+	def output_args(self):
+		return ['-c:v', self.encoder]
+
+	def available(self, encoders):
+		return self.encoder in encoders
+
+class NvencBackend(EncoderBackend):
+	name = 'nvenc'
+	encoder = 'h264_nvenc'
+
+	def input_args(self, hw_frames=False):
+		## Decode on the GPU. Frames are copied back for CPU filters unless
+		## nothing needs to touch them before the encoder
+		args = ['-hwaccel', 'cuda']
+		if hw_frames:
+			args += ['-hwaccel_output_format', 'cuda']
+		return args
+
+class X264Backend(EncoderBackend):
+	name = 'libx264'
+	encoder = 'libx264'
+
+	def output_args(self):
+		args = ['-c:v', self.encoder, '-preset', config.X264_PRESET]
+		if config.X264_THREADS:
+			args += ['-threads', str(config.X264_THREADS)]
+		return args
+
+class CopyBackend(EncoderBackend):
+	name = 'copy'
+	encodes = False
+
+	def output_args(self):
+		return ['-c:v', 'copy']
+
+	def available(self, encoders):
+		return True
+
+BACKENDS = {b.name: b for b in (NvencBackend(), X264Backend(), CopyBackend())}
+
+_encoders = None
+_selected = None
+_lock = threading.Lock()
+
+def available_encoders():
+	global _encoders
+	if _encoders is not None:
+		return _encoders
+
+	process = subprocess.Popen(
+		[config.FFMPEG_PATH, '-hide_banner', '-encoders'],
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL
+	)
+	data, err = process.communicate()
+
+	## After a legend ending in " ------" lines look like
+	## " V....D libx264   libx264 H.264 / AVC ..."
+	_encoders = set()
+	in_list = False
+	for line in data.decode('utf-8', 'replace').splitlines():
+		parts = line.split()
+		if not in_list:
+			in_list = parts == ['------']
+			continue
+		if len(parts) >= 2:
+			_encoders.add(parts[1])
+	return _encoders
+
+def benchmark(backend, seconds=5):
+	## Encode a synthetic 1080p clip as fast as possible and return how many
+	## times faster than realtime it went, or None if the encode failed
+	ffmpeg_params = [
+		config.FFMPEG_PATH,
+		'-hide_banner',
+		'-v', 'error'
+	] + backend.input_args() + [
+		'-f', 'lavfi',
+		'-i', f'testsrc2=size=1920x1080:rate=30000/1001:duration={seconds}',
+		'-vf', 'format=yuv420p'
+	] + backend.output_args() + [
+		'-f', 'null',
+		'-'
+	]
+
+	started = time.monotonic()
+	process = subprocess.Popen(
+		ffmpeg_params,
+		stdout=subprocess.DEVNULL,
+		stderr=subprocess.DEVNULL
+	)
+	process.wait()
+	elapsed = time.monotonic() - started
+
+	if process.returncode != 0:
+		return None
+	return seconds / max(elapsed, 0.001)
+
+def calibrate(seconds=5):
+	encoders = available_encoders()
+	margin = config.ENCODER_REALTIME_MARGIN
+
+	results = {}
+	for backend in BACKENDS.values():
+		if not backend.encodes:
+			continue
+		if not backend.available(encoders):
+			_print(f"Encoder {backend.name} not available in ffmpeg", LOG_LEVEL_DEBUG)
+			continue
+
+		speed = benchmark(backend, seconds)
+		if speed is None:
+			## Listed but unusable, e.g. NVENC without a GPU
+			_print(f"Encoder {backend.name} failed calibration", LOG_LEVEL_INFO)
+			continue
+		_print(f"Encoder {backend.name} runs at {speed:.2f}x realtime", LOG_LEVEL_INFO)
+		results[backend.name] = speed
+
+	if not results:
+		_print("No encoder passed calibration, falling back to libx264", LOG_LEVEL_ERROR)
+		return BACKENDS['libx264']
+
+	best = max(results, key=results.get)
+	if results[best] < margin:
+		_print(f"No encoder keeps {margin}x realtime, using fastest ({best})", LOG_LEVEL_ERROR)
+	else:
+		_print(f"Using encoder {best}", LOG_LEVEL_INFO)
+	return BACKENDS[best]
+
+def get_backend(name=None, logger=None):
+	global _selected
+	if logger is not None:
+		global _print
+		_print = logger._print
+
+	if name is None:
+		name = config.ENCODER
+		## Everything that asks for the configured encoder runs a filter
+		## graph, which copy can't do. The player picks copy itself for
+		## mezzanines
+		if name != 'auto' and (name not in BACKENDS or not BACKENDS[name].encodes):
+			choices = ", ".join(["'auto'"] + [f"'{b.name}'" for b in BACKENDS.values() if b.encodes])
+			raise ValueError(f"ENCODER in config.py must be one of {choices}, not '{name}'")
+
+	if name != 'auto':
+		return BACKENDS[name]
+
+	## Calibrate once per process, even with several channels starting
+	## at the same time
+	with _lock:
+		if _selected is None:
+			_selected = calibrate()
+	return _selected
@@ -0,0 +1,79 @@
+WIDTH = 1920
+HEIGHT = 1080
+SAMPLE_RATE = 44100
+CHANNELS = 1
+
+def find_stream(probe, index):
+	if probe is None:
+		return None
+	for stream in probe.get('streams', []):
+		if stream.get('index') == index:
+			return stream
+	return None
+
+def relative_index(probe, index, codec_type):
+	## ffmpeg's 0:v:N counts only streams of that type, while probe indexes
+	## count every stream in the file
+	if probe is None:
+		return 0
+	n = 0
+	for stream in probe.get('streams', []):
+		if stream.get('index') == index:
+			return n
+		if stream.get('codec_type') == codec_type:
+			n += 1
+	return 0
+
+class FilterPlan:
+	def __init__(self, probe, video_track, audio_track):
+		video = find_stream(probe, video_track)
+		audio = find_stream(probe, audio_track)
+
+		self.video_input = f"0:v:{relative_index(probe, video_track, 'video')}"
+		self.stages = self._video_stages(video)
+		self.audio_args = self._audio_args(audio)
+
+	def _video_stages(self, video):
+		## Without probe data assume every stage is needed
+		if video is None:
+			return [
+				f'scale={WIDTH}:{HEIGHT}:force_original_aspect_ratio=decrease',
+				f'pad={WIDTH}:{HEIGHT}:(ow-iw)/2:(oh-ih)/2',
+				'setsar=1',
+				'format=yuv420p'
+			]
+
+		width = video.get('width')
+		height = video.get('height')
+		sar = video.get('sample_aspect_ratio', '1:1')
+
+		stages = []
+		if (width, height) != (WIDTH, HEIGHT):
+			stages.append(f'scale={WIDTH}:{HEIGHT}:force_original_aspect_ratio=decrease')
+			if not width or not height or width * HEIGHT != height * WIDTH:
+				stages.append(f'pad={WIDTH}:{HEIGHT}:(ow-iw)/2:(oh-ih)/2')
+		## Scaling can leave a rounding error in the SAR, so reset it then too.
+		## 0:1 means unknown, which players treat as square
+		if stages or sar not in ('1:1', '0:1'):
+			stages.append('setsar=1')
+		if video.get('pix_fmt') != 'yuv420p':
+			stages.append('format=yuv420p')
+		return stages
+
+	def _audio_args(self, audio):
+		args = []
+		if audio is None or str(audio.get('sample_rate')) != str(SAMPLE_RATE):
+			args += ['-ar', str(SAMPLE_RATE)]
+		if audio is None or audio.get('channels') != CHANNELS:
+			args += ['-ac', str(CHANNELS)]
+		return args
+
+	def video_chain(self):
+		## Filter segments and the label the next filter should read from
+		if not self.stages:
+			return [], self.video_input
+		return [f"[{self.video_input}]{','.join(self.stages)}[v]"], 'v'
+
+	@property
+	def converts_pix_fmt(self):
+		return 'format=yuv420p' in self.stages
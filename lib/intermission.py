@@ -9,7 +9,10 @@ from gtts import gTTS
 from pyt2s.services import ibm_watson
 from pydub import AudioSegment
 
-from lib.common import get_mysql_connection, Logger
+from lib.common import get_mysql_connection, get_media_file_ids, Logger
+from lib.probe import ProbeCache
+from lib.encoders import get_backend
+from lib.queries import FUTURE_INTERMISSIONS, ITEM_BEFORE_INTERMISSION, ITEMS_AFTER_INTERMISSION
 from lib.vars import *
 import config
 
@@ -27,6 +30,7 @@ def normalize_text(t):
 class Intermission:
 	def __init__(self, logger=None):
 		self._setup_output_dirs()
+		self._logger = logger
 		if logger is not None:
 			global _print
 			_print = logger._print
@@ -47,38 +51,33 @@ class Intermission:
 			"ORDER BY start_time"
 			)
 		else:
-			q = (
-				"SELECT * FROM schedule "
-				"WHERE start_time > %s "
-				"AND tag = 'INTERMISSION' "
-				"AND path IS NULL "
-				"ORDER BY start_time"
-			)
+			q = FUTURE_INTERMISSIONS
 		cur.execute(q, (datetime.now(), ))
 		intermissions = cur.fetchall()
 		_print(f"Need to generate {len(intermissions)} intermission(s)", LOG_LEVEL_INFO)
 
+		probe_cache = ProbeCache(db)
+
 		for i in intermissions:
-			q = (
-				"SELECT id FROM schedule "
-				"WHERE start_time >= %s "
-				"AND tag != 'INTERMISSION' "
-				"LIMIT 4"
-			)
-			cur.execute(q, (i['end_time'],))
+			cur.execute(ITEMS_AFTER_INTERMISSION, (i['channel_id'], i['end_time'], 4))
 			res = cur.fetchall()
 			if len(res) < 4:
 				_print(f'Not enough future scheduled items for intermission {i["id"]}', LOG_LEVEL_DEBUG)
 				continue
 
 			intermission_file = self.generate_intermission_video(i['id'])
+			if not intermission_file:
+				continue
 			_print(f"Generated intermission {intermission_file}", LOG_LEVEL_INFO)
+			## Probe now so the player finds it in the cache at air time
+			probe_cache.get(intermission_file)
+			media_file_id = get_media_file_ids(db, [intermission_file])[intermission_file]
 			q = (
 				"UPDATE schedule "
-				"SET path = %s "
+				"SET media_file_id = %s "
 				"WHERE id = %s"
 			)
-			cur.execute(q, (intermission_file, i['id']))
+			cur.execute(q, (media_file_id, i['id']))
 			db.commit()
 
 		cur.close()
@@ -89,10 +88,12 @@ class Intermission:
 		cur = db.cursor(dictionary=True)
 
 		q = (
-			"SELECT * FROM schedule "
-			"WHERE end_time < %s "
-			"AND tag = 'INTERMISSION' "
-			"AND path IS NOT NULL"
+			"SELECT schedule.*, media_files.path "
+			"FROM schedule "
+			"INNER JOIN media_files "
+			"ON schedule.media_file_id = media_files.id "
+			"WHERE schedule.end_time < %s "
+			"AND schedule.tag = 'INTERMISSION'"
 		)
 		cur.execute(q, (datetime.now(), ))
 		old = cur.fetchall()
@@ -101,12 +102,12 @@ class Intermission:
 
 		for s in old:
 			os.remove(s['path'])
+			## schedule.media_file_id is cleared by the foreign key
 			q = (
-				"UPDATE schedule "
-				"SET path = NULL "
+				"DELETE FROM media_files "
 				"WHERE id = %s"
 			)
-			cur.execute(q, (s['id'], ))
+			cur.execute(q, (s['media_file_id'], ))
 			db.commit()
 
 		cur.close()
@@ -138,13 +139,7 @@ class Intermission:
 			db.close()
 			return False
 		
-		q = (
-			"SELECT * FROM schedule "
-			"WHERE start_time >= %s "
-			"AND tag != 'INTERMISSION' "
-			"LIMIT 4"
-		)
-		cur.execute(q, (intermission_schedule['end_time'],))
+		cur.execute(ITEMS_AFTER_INTERMISSION, (intermission_schedule['channel_id'], intermission_schedule['end_time'], 4))
 		future_schedule = cur.fetchall()
 
 		filters = ""
@@ -204,13 +199,14 @@ class Intermission:
 		intermission_file = os.path.join(config.INTERMISSION_OUTPUT_PATH, 'complete/', f"{intermission_schedule['id']}.mp4")
 		background_video_file = random.choice(os.listdir(os.path.join(config.INTERMISSION_RESOURCE_PATH, 'backgrounds/')))
 		background_video_file = os.path.join(config.INTERMISSION_RESOURCE_PATH, 'backgrounds/', background_video_file)
+		encoder = get_backend(logger=self._logger)
 		ffmpeg_params = [
-			config.FFMPEG_PATH,
-			'-hwaccel_output_format', 'cuda',
+			config.FFMPEG_PATH
+		] + encoder.input_args() + [
 			'-i', background_video_file,
 			'-i', audio_track,
-			'-vf', filters,
-			'-c:v', 'h264_nvenc',
+			'-vf', filters
+		] + encoder.output_args() + [
 			'-pix_fmt', 'yuv420p',
 			'-r', '30000/1001',
 			'-c:a', 'aac',
@@ -255,23 +251,10 @@ class Intermission:
 			db.close()
 			return ""
 
-		q = (
-			"SELECT * FROM schedule "
-			"WHERE end_time <= %s "
-			"AND tag != 'INTERMISSION' "
-			"ORDER BY end_time DESC "
-			"LIMIT 1"
-		)
-		cur.execute(q, (intermission_schedule['start_time'], ))
+		cur.execute(ITEM_BEFORE_INTERMISSION, (intermission_schedule['channel_id'], intermission_schedule['start_time']))
 		previous_schedule = cur.fetchone()
 
-		q = (
-			"SELECT * FROM schedule "
-			"WHERE start_time >= %s "
-			"AND tag != 'INTERMISSION' "
-			"LIMIT %s"
-		)
-		cur.execute(q, (intermission_schedule['end_time'], future_items))
+		cur.execute(ITEMS_AFTER_INTERMISSION, (intermission_schedule['channel_id'], intermission_schedule['end_time'], future_items))
 		future_schedule = cur.fetchall()
 
 		if not future_schedule:
@@ -0,0 +1,265 @@
+import random
+from datetime import datetime
+
+from lib.common import update_by_id, Logger
+from lib.vars import *
+import config
+
+_print = Logger()._print
+
+class EpisodeIndex:
+	def __init__(self, logger=None):
+		## tv_show_id -> episodes sorted by (season_number, episode_number)
+		self._episodes = {}
+		## tv_show_id -> position of the next episode to play
+		self._cursors = {}
+		## tv_show_id -> episode id that has been played this run
+		self._played = {}
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def load(self, db, shows=None):
+		cur = db.cursor(dictionary=True)
+
+		if shows is None:
+			q = (
+				"SELECT id, last_played_episode "
+				"FROM tv_shows "
+				"WHERE enabled = 1"
+			)
+			cur.execute(q)
+			shows = cur.fetchall()
+
+		q = (
+			"SELECT tv_episodes.*, media_files.path "
+			"FROM tv_episodes "
+			"INNER JOIN tv_shows "
+			"ON tv_episodes.tv_show_id = tv_shows.id "
+			"INNER JOIN media_files "
+			"ON tv_episodes.media_file_id = media_files.id "
+			"WHERE tv_shows.enabled = 1 "
+			"ORDER BY tv_episodes.tv_show_id, "
+			"tv_episodes.season_number, "
+			"tv_episodes.episode_number"
+		)
+		cur.execute(q)
+
+		self._episodes = {show['id']: [] for show in shows}
+		for episode in cur:
+			self._episodes[episode['tv_show_id']].append(episode)
+		cur.close()
+
+		self._cursors = {}
+		self._played = {}
+		for show in shows:
+			self._cursors[show['id']] = self._find_next(
+				self._episodes[show['id']],
+				show['last_played_episode']
+			)
+
+		_print(f"Loaded episode index for {len(shows)} show(s)", LOG_LEVEL_DEBUG)
+
+	def _find_next(self, episodes, last_played):
+		if last_played is None:
+			return 0
+
+		## When episodes are changed on disk orphaned records are possibly
+		## created. Reset to first season and episode if that happens
+		for position, episode in enumerate(episodes):
+			if episode['id'] == last_played:
+				return (position + 1) % len(episodes)
+		return 0
+
+	def shows(self):
+		return list(self._episodes.keys())
+
+	def episodes(self, tv_show_id):
+		return self._episodes.get(tv_show_id, [])
+
+	def peek(self, tv_show_id):
+		episodes = self._episodes.get(tv_show_id)
+		if not episodes:
+			return None
+		return episodes[self._cursors[tv_show_id]]
+
+	def advance(self, tv_show_id):
+		episodes = self._episodes.get(tv_show_id)
+		if not episodes:
+			return None
+		position = self._cursors[tv_show_id]
+		self._played[tv_show_id] = episodes[position]['id']
+		self._cursors[tv_show_id] = (position + 1) % len(episodes)
+		return episodes[position]
+
+	def save(self, cur):
+		if not self._played:
+			return 0
+
+		## Single UPDATE for every show that moved this run
+		saved = update_by_id(cur, 'tv_shows', 'last_played_episode', self._played)
+		self._played = {}
+		return saved
+
+
+class Library:
+	def __init__(self, logger=None):
+		self.shows = {}
+		self.movies = []
+		self.last_aired = {}
+		self.stats = {}
+		self.episodes = EpisodeIndex(logger=logger)
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def load(self, db):
+		cur = db.cursor(dictionary=True)
+
+		q = "SELECT * FROM tv_shows WHERE enabled = 1"
+		cur.execute(q)
+		shows = cur.fetchall()
+		self.shows = {show['id']: show for show in shows}
+
+		q = "SELECT * FROM movies WHERE enabled = 1"
+		cur.execute(q)
+		self.movies = cur.fetchall()
+
+		q = (
+			"SELECT tv_show_stats.* "
+			"FROM tv_show_stats "
+			"INNER JOIN tv_shows "
+			"ON tv_show_stats.tv_show_id = tv_shows.id "
+			"WHERE tv_shows.enabled = 1"
+		)
+		cur.execute(q)
+		self.stats = {r['tv_show_id']: r for r in cur.fetchall()}
+
+		if config.SHOW_WEIGHTING == 'recency':
+			q = (
+				"SELECT tv_episodes.tv_show_id, MAX(schedule.start_time) AS last_aired "
+				"FROM schedule "
+				"INNER JOIN tv_episodes "
+				"ON schedule.media_file_id = tv_episodes.media_file_id "
+				"GROUP BY tv_episodes.tv_show_id"
+			)
+			cur.execute(q)
+			self.last_aired = {r['tv_show_id']: r['last_aired'] for r in cur.fetchall()}
+		cur.close()
+
+		self.episodes.load(db, shows=shows)
+		_print(f"Loaded library with {len(self.shows)} show(s) and {len(self.movies)} movie(s)", LOG_LEVEL_DEBUG)
+
+	def playable_shows(self):
+		return [show_id for show_id in self.shows if self.episodes.episodes(show_id)]
+
+	def show_stat(self, show_id, key):
+		stats = self.stats.get(show_id)
+		if stats is None:
+			return 0
+		return stats[key]
+
+	def marathon_shows(self, min_duration=72000):
+		return [
+			show_id for show_id in self.playable_shows()
+			if self.show_stat(show_id, 'total_duration') >= min_duration
+		]
+
+	def show_weights(self, weighting=None, now=None):
+		if weighting is None:
+			return None
+
+		weights = {}
+		if weighting == 'runtime':
+			for show_id in self.playable_shows():
+				weights[show_id] = self.show_stat(show_id, 'total_duration')
+		elif weighting == 'recency':
+			if now is None:
+				now = datetime.now()
+			## Hours since the show last aired, capped at 30 days. Shows that
+			## have never aired get the cap
+			cap = 30 * 24
+			for show_id in self.playable_shows():
+				last_aired = self.last_aired.get(show_id)
+				if last_aired is None:
+					weights[show_id] = cap
+				else:
+					hours = (now - last_aired).total_seconds() / 3600.0
+					weights[show_id] = min(max(hours, 1), cap)
+		else:
+			_print(f"Unknown show weighting '{weighting}', picking uniformly", LOG_LEVEL_ERROR)
+			return None
+		return weights
+
+	def sampler(self, weighting=None, rng=None):
+		show_ids = self.playable_shows()
+		weights = self.show_weights(weighting)
+		if weights is not None:
+			weights = [weights[show_id] for show_id in show_ids]
+		return ShowSampler(show_ids, weights=weights, rng=rng)
+
+
+class ShowSampler:
+	def __init__(self, show_ids, weights=None, rng=None):
+		self._show_ids = list(show_ids)
+		self._show_set = set(self._show_ids)
+		self._rng = rng if rng is not None else random
+
+		self._prob = None
+		self._alias = None
+		if weights is not None and self._show_ids:
+			self._build_alias(weights)
+
+	def __len__(self):
+		return len(self._show_ids)
+
+	def _build_alias(self, weights):
+		## Vose's alias method so weighted draws are O(1)
+		n = len(weights)
+		total = float(sum(weights))
+		if total <= 0:
+			return
+
+		scaled = [w * n / total for w in weights]
+		self._prob = [0.0] * n
+		self._alias = [0] * n
+		small = [i for i, p in enumerate(scaled) if p < 1.0]
+		large = [i for i, p in enumerate(scaled) if p >= 1.0]
+
+		while small and large:
+			s = small.pop()
+			l = large.pop()
+			self._prob[s] = scaled[s]
+			self._alias[s] = l
+			scaled[l] = (scaled[l] + scaled[s]) - 1.0
+			if scaled[l] < 1.0:
+				small.append(l)
+			else:
+				large.append(l)
+
+		for i in large + small:
+			self._prob[i] = 1.0
+
+	def _draw(self):
+		i = self._rng.randrange(len(self._show_ids))
+		if self._prob is not None and self._rng.random() >= self._prob[i]:
+			i = self._alias[i]
+		return self._show_ids[i]
+
+	def pick(self, exclude=()):
+		exclude = self._show_set.intersection(exclude)
+		if len(exclude) >= len(self._show_ids):
+			return None
+
+		## Exclusion sets are tiny (previous show, marathon show) so
+		## rejection sampling almost always succeeds on the first draw
+		for _ in range(64):
+			show_id = self._draw()
+			if show_id not in exclude:
+				return show_id
+
+		## Heavily weighted excluded shows; fall back to a scan
+		candidates = [show_id for show_id in self._show_ids if show_id not in exclude]
+		return self._rng.choice(candidates)
@@ -1,13 +1,14 @@
 import os
 import re
-import subprocess
 from pathlib import Path
 from datetime import datetime, timedelta
 
 from imdb import Cinemagoer
 import tvdb_v4_official
 
-from lib.common import get_mysql_connection, get_image_dimensions, Logger
+from lib.common import get_mysql_connection, get_media_file_ids, get_image_dimensions, update_by_id, Logger
+from lib.probe import ProbeCache, get_duration
+from lib.queries import SCHEDULED_MEDIA_FILE
 from lib.vars import *
 import config
 
@@ -16,6 +17,7 @@ _print = Logger()._print
 class MetadataMixin:
 	def __init__(self, logger=None):
 		self._db = get_mysql_connection()
+		self._probe_cache = ProbeCache(self._db, logger=logger)
 		if logger is not None:
 			global _print
 			_print = logger._print
@@ -24,18 +26,12 @@ class MetadataMixin:
 		self._db.close()
 	
 	def get_video_duration(self, path):
-		try:
-			sp = subprocess.run([
-				config.FFPROBE_PATH, "-v", "panic", 
-				"-show_entries", "format=duration",
-				"-of", "default=noprint_wrappers=1:nokey=1", 
-				path
-			], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-			return int(float(sp.stdout))
-		except:
+		## Probing here also fills the stream cache the player reads from
+		duration = get_duration(self._probe_cache.get(path))
+		if duration is None:
 			_print(f"Error getting duration for folowing file:", LOG_LEVEL_ERROR)
 			_print(path, LOG_LEVEL_ERROR)
-			return None
+		return duration
 
 	def get_file_size_mb(self, path):
 		return os.path.getsize(path) / (1024*1024)
@@ -302,7 +298,13 @@ class TVScanner(MetadataMixin):
 				for file in files:
 					full_path = os.path.join(current_folder, file)
 
-					q = "SELECT id FROM tv_episodes WHERE path = %s"
+					q = (
+						"SELECT tv_episodes.id "
+						"FROM tv_episodes "
+						"INNER JOIN media_files "
+						"ON tv_episodes.media_file_id = media_files.id "
+						"WHERE media_files.path = %s"
+					)
 					cur.execute(q, (full_path, ))
 					res = cur.fetchone()
 					if res:
@@ -342,11 +344,12 @@ class TVScanner(MetadataMixin):
 						_print(f"Could not match {file} to any episode. Skippping...", LOG_LEVEL_INFO)
 						continue
 
+					media_file_id = get_media_file_ids(self._db, [full_path])[full_path]
 					q = (
 						"INSERT INTO tv_episodes "
 						"(tv_show_id, "
 						"tvdb_id, "
-						"path, "
+						"media_file_id, "
 						"duration, "
 						"season_number, "
 						"episode_number, "
@@ -357,13 +360,14 @@ class TVScanner(MetadataMixin):
 					cur.execute(q, (
 						r['id'],
 						this_episode['id'],
-						full_path,
+						media_file_id,
 						duration,
 						season_number,
 						episode_number,
 						this_episode['overview'],
 						datetime.now()
 					))
+					self._add_to_show_stats(cur, r['id'], duration)
 					self._db.commit()
 
 		cur.close()
@@ -372,10 +376,12 @@ class TVScanner(MetadataMixin):
 		cur = self._db.cursor(dictionary=True)
 
 		q = (
-			"SELECT tv_episodes.*, tv_shows.title "
+			"SELECT tv_episodes.*, tv_shows.title, media_files.path "
 			"FROM tv_episodes "
 			"LEFT JOIN tv_shows "
-			"ON tv_episodes.tv_show_id = tv_shows.id"
+			"ON tv_episodes.tv_show_id = tv_shows.id "
+			"INNER JOIN media_files "
+			"ON tv_episodes.media_file_id = media_files.id"
 		)
 		cur.execute(q)
 		episodes = cur.fetchall()
@@ -388,12 +394,14 @@ class TVScanner(MetadataMixin):
 			_print(f"  {episode['title']} S{episode['season_number']}E{episode['episode_number']}", LOG_LEVEL_INFO)
 			_print(f"  {episode['path']}", LOG_LEVEL_INFO)
 			q = (
-				"SELECT * "
+				"SELECT tv_episodes.*, media_files.path "
 				"FROM tv_episodes "
-				"WHERE id != %s "
-				"AND tv_show_id = %s "
-				"AND season_number = %s "
-				"AND episode_number = %s"
+				"INNER JOIN media_files "
+				"ON tv_episodes.media_file_id = media_files.id "
+				"WHERE tv_episodes.id != %s "
+				"AND tv_episodes.tv_show_id = %s "
+				"AND tv_episodes.season_number = %s "
+				"AND tv_episodes.episode_number = %s"
 			)
 			cur.execute(q, (
 				episode['id'],
@@ -410,8 +418,7 @@ class TVScanner(MetadataMixin):
 				for r in replacements:
 					_print(f"  {r['path']}", LOG_LEVEL_INFO)
 			
-			q = "SELECT * FROM schedule WHERE path = %s AND end_time >= NOW()"
-			cur.execute(q, (episode['path'], ))
+			cur.execute(SCHEDULED_MEDIA_FILE, (episode['media_file_id'], ))
 			scheduled = cur.fetchall()
 
 			if scheduled:
@@ -424,48 +431,106 @@ class TVScanner(MetadataMixin):
 
 			q = "DELETE FROM tv_episodes WHERE id = %s"
 			cur.execute(q, (episode['id'], ))
+			self._remove_from_show_stats(cur, episode['tv_show_id'], episode['duration'])
 			self._db.commit()
 
 		cur.close()
 
+	def rebuild_show_stats(self):
+		cur = self._db.cursor()
+
+		q = "DELETE FROM tv_show_stats"
+		cur.execute(q)
+
+		q = (
+			"INSERT INTO tv_show_stats "
+			"(tv_show_id, episode_count, total_duration, "
+			"mean_duration, max_duration, last_updated) "
+			"SELECT tv_show_id, COUNT(*), SUM(duration), "
+			"AVG(duration), MAX(duration), NOW() "
+			"FROM tv_episodes "
+			"GROUP BY tv_show_id"
+		)
+		cur.execute(q)
+		_print(f"Rebuilt stats for {cur.rowcount} show(s)", LOG_LEVEL_INFO)
+
+		self._db.commit()
+		cur.close()
+
+	def _add_to_show_stats(self, cur, tv_show_id, duration):
+		## Assignments are applied left to right so mean_duration sees the
+		## updated count and total
+		q = (
+			"INSERT INTO tv_show_stats "
+			"(tv_show_id, episode_count, total_duration, "
+			"mean_duration, max_duration, last_updated) "
+			"VALUES (%s, 1, %s, %s, %s, NOW()) "
+			"ON DUPLICATE KEY UPDATE "
+			"episode_count = episode_count + 1, "
+			"total_duration = total_duration + VALUES(total_duration), "
+			"mean_duration = total_duration / episode_count, "
+			"max_duration = GREATEST(max_duration, VALUES(max_duration)), "
+			"last_updated = NOW()"
+		)
+		cur.execute(q, (tv_show_id, duration, duration, duration))
+
+	def _remove_from_show_stats(self, cur, tv_show_id, duration):
+		## The max can't be decremented so it is looked up again for this show
+		q = (
+			"UPDATE tv_show_stats "
+			"SET episode_count = GREATEST(episode_count - 1, 0), "
+			"total_duration = GREATEST(total_duration - %s, 0), "
+			"mean_duration = IF(episode_count > 0, total_duration / episode_count, 0), "
+			"max_duration = COALESCE("
+				"(SELECT MAX(duration) FROM tv_episodes WHERE tv_show_id = %s), 0"
+			"), "
+			"last_updated = NOW() "
+			"WHERE tv_show_id = %s"
+		)
+		cur.execute(q, (duration, tv_show_id, tv_show_id))
+
 	def cleanup_last_played_episodes(self):
 		cur = self._db.cursor(dictionary=True)
 
+		## Most recently scheduled episode of every show in a single pass
 		q = (
-			"SELECT id, last_played_episode, title "
+			"SELECT tv_shows.id, tv_shows.last_played_episode, tv_shows.title, "
+			"latest.episode_id "
 			"FROM tv_shows "
-			"WHERE verified = 1 "
-			"AND enabled = 1"
+			"LEFT JOIN ("
+				"SELECT tv_show_id, episode_id "
+				"FROM ("
+					"SELECT tv_episodes.tv_show_id, tv_episodes.id AS episode_id, "
+					"ROW_NUMBER() OVER ("
+						"PARTITION BY tv_episodes.tv_show_id "
+						"ORDER BY schedule.start_time DESC"
+					") AS row_num "
+					"FROM schedule "
+					"INNER JOIN tv_episodes "
+					"ON schedule.media_file_id = tv_episodes.media_file_id"
+				") ranked "
+				"WHERE row_num = 1"
+			") latest "
+			"ON latest.tv_show_id = tv_shows.id "
+			"WHERE tv_shows.verified = 1 "
+			"AND tv_shows.enabled = 1"
 		)
 		cur.execute(q)
 		shows = cur.fetchall()
 
+		mismatched = []
 		for show in shows:
-			## This is a shitty thing to do with this path join
-			## File paths should realistically be stored in their own table
-			q = (
-				"SELECT tv_episodes.id AS episode_id "
-				"FROM schedule "
-				"LEFT JOIN tv_episodes "
-				"ON schedule.path = tv_episodes.path "
-				"LEFT JOIN tv_shows "
-				"ON tv_episodes.tv_show_id = tv_shows.id "
-				"WHERE tv_shows.id = %s "
-				"ORDER BY schedule.start_time DESC "
-				"LIMIT 1"
-			)
-			cur.execute(q, (show['id'], ))
-			last_played = cur.fetchone()
-			last_played_episode_id = None
-			if last_played:
-				last_played_episode_id = last_played['episode_id']
-
-			if last_played_episode_id == show['last_played_episode']:
+			if show['episode_id'] == show['last_played_episode']:
 				_print(f"Last played matches for {show['title']}", LOG_LEVEL_INFO)
 			else:
 				_print(f"Mismatch for {show['title']}! Fixing...", LOG_LEVEL_INFO)
-				q = "UPDATE tv_shows SET last_played_episode = %s WHERE id = %s"
-				cur.execute(q, (last_played_episode_id, show['id']))
-		self._db.commit()	
+				mismatched.append(show)
 
-		cur.close()
\ No newline at end of file
+		update_by_id(
+			cur, 'tv_shows', 'last_played_episode',
+			{show['id']: show['episode_id'] for show in mismatched}
+		)
+		self._db.commit()
+
+		_print(f"Fixed {len(mismatched)} of {len(shows)} show(s)", LOG_LEVEL_INFO)
+		cur.close()
@@ -0,0 +1,316 @@
+from datetime import datetime
+
+from lib.common import get_mysql_connection, Logger
+from lib.queries import (
+	PLAYER_CURRENT_ITEM, PLAYER_FIRST_UPCOMING_ITEM, PLAYER_LOOKAHEAD_WINDOW,
+	SCHEDULE_TAIL, PREVIOUS_INTERMISSION, ITEM_BEFORE_INTERMISSION, ITEMS_AFTER_INTERMISSION,
+	FUTURE_INTERMISSIONS, SCHEDULED_MEDIA_FILE, PROBE_CACHE_LOOKUP, PURGE_CHUNK, PURGE_ARCHIVE_CHUNK
+)
+from lib.vars import *
+
+_print = Logger()._print
+
+## (version, description, steps). A step is either an SQL statement or a
+## function taking a cursor. New migrations go at the end and schema.sql
+## should be updated to match so fresh installs start at the latest version
+MIGRATIONS = [
+	(1, "Add schedule indexes for player, scheduler and intermission queries", [
+		"CREATE INDEX idx_schedule_start_time ON schedule (start_time)",
+		"CREATE INDEX idx_schedule_end_time ON schedule (end_time)",
+		"CREATE INDEX idx_schedule_tag_start_time ON schedule (tag, start_time)",
+		"CREATE INDEX idx_schedule_tag_end_time ON schedule (tag, end_time)",
+		"CREATE INDEX idx_schedule_path ON schedule (path)",
+	]),
+	(2, "Add episode ordering index", [
+		"CREATE INDEX idx_episode_show_order ON tv_episodes (tv_show_id, season_number, episode_number)",
+	]),
+	(3, "Add tv_show_stats table", [
+		(
+			"CREATE TABLE IF NOT EXISTS tv_show_stats ("
+				"tv_show_id INT NOT NULL, "
+				"episode_count INT NOT NULL DEFAULT 0, "
+				"total_duration INT NOT NULL DEFAULT 0, "
+				"mean_duration INT NOT NULL DEFAULT 0, "
+				"max_duration INT NOT NULL DEFAULT 0, "
+				"last_updated DATETIME DEFAULT NULL, "
+				"PRIMARY KEY (tv_show_id), "
+				"INDEX idx_show_stats_total_duration (total_duration)"
+			")"
+		),
+		(
+			"INSERT IGNORE INTO tv_show_stats "
+			"(tv_show_id, episode_count, total_duration, "
+			"mean_duration, max_duration, last_updated) "
+			"SELECT tv_show_id, COUNT(*), SUM(duration), "
+			"AVG(duration), MAX(duration), NOW() "
+			"FROM tv_episodes "
+			"GROUP BY tv_show_id"
+		),
+	]),
+	(4, "Move media file paths into media_files", [
+		## Paths are compared byte for byte. The default collation would
+		## fold case and accents and merge distinct files into one row
+		(
+			"CREATE TABLE media_files ("
+				"id INT NOT NULL AUTO_INCREMENT, "
+				"path VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL, "
+				"PRIMARY KEY (id), "
+				"UNIQUE KEY idx_media_files_path (path)"
+			")"
+		),
+		"INSERT IGNORE INTO media_files (path) SELECT DISTINCT path FROM tv_episodes",
+		"INSERT IGNORE INTO media_files (path) SELECT DISTINCT path FROM schedule WHERE path IS NOT NULL",
+		"ALTER TABLE tv_episodes ADD COLUMN media_file_id INT DEFAULT NULL AFTER tvdb_id",
+		(
+			"UPDATE tv_episodes "
+			"INNER JOIN media_files "
+			"ON tv_episodes.path = media_files.path "
+			"SET tv_episodes.media_file_id = media_files.id"
+		),
+		(
+			"ALTER TABLE tv_episodes "
+			"MODIFY media_file_id INT NOT NULL, "
+			"DROP INDEX idx_episode_path, "
+			"DROP COLUMN path, "
+			"ADD INDEX idx_episode_media_file (media_file_id), "
+			"ADD CONSTRAINT fk_episode_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id)"
+		),
+		"ALTER TABLE schedule ADD COLUMN media_file_id INT DEFAULT NULL AFTER description",
+		(
+			"UPDATE schedule "
+			"INNER JOIN media_files "
+			"ON schedule.path = media_files.path "
+			"SET schedule.media_file_id = media_files.id"
+		),
+		(
+			"ALTER TABLE schedule "
+			"DROP INDEX idx_schedule_path, "
+			"DROP COLUMN path, "
+			"ADD INDEX idx_schedule_media_file (media_file_id), "
+			"ADD CONSTRAINT fk_schedule_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id) ON DELETE SET NULL"
+		),
+	]),
+	(5, "Cache ffprobe output on media_files", [
+		(
+			"ALTER TABLE media_files "
+			"ADD COLUMN size BIGINT DEFAULT NULL, "
+			"ADD COLUMN mtime DOUBLE DEFAULT NULL, "
+			"ADD COLUMN probe_data MEDIUMTEXT DEFAULT NULL, "
+			"ADD COLUMN probed_at DATETIME DEFAULT NULL"
+		),
+	]),
+	(6, "Track schedule revisions for the player lookahead", [
+		(
+			"CREATE TABLE schedule_revision ("
+				"id TINYINT NOT NULL, "
+				"revision BIGINT NOT NULL DEFAULT 0, "
+				"PRIMARY KEY (id)"
+			")"
+		),
+		"INSERT INTO schedule_revision (id, revision) VALUES (1, 0)",
+		(
+			"CREATE TRIGGER trg_schedule_revision_insert AFTER INSERT ON schedule "
+			"FOR EACH ROW "
+			"UPDATE schedule_revision SET revision = revision + 1 WHERE id = 1"
+		),
+		(
+			"CREATE TRIGGER trg_schedule_revision_delete AFTER DELETE ON schedule "
+			"FOR EACH ROW "
+			"UPDATE schedule_revision SET revision = revision + 1 WHERE id = 1"
+		),
+		## Status writes from the player don't change what it should play
+		(
+			"CREATE TRIGGER trg_schedule_revision_update AFTER UPDATE ON schedule "
+			"FOR EACH ROW "
+			"UPDATE schedule_revision SET revision = revision + 1 "
+			"WHERE id = 1 "
+			"AND (NEW.start_time <> OLD.start_time "
+				"OR NEW.end_time <> OLD.end_time "
+				"OR NOT (NEW.media_file_id <=> OLD.media_file_id))"
+		),
+	]),
+	(7, "Add channel_id to schedule", [
+		(
+			"ALTER TABLE schedule "
+			"ADD COLUMN channel_id INT NOT NULL DEFAULT 1 AFTER id, "
+			"ADD INDEX idx_schedule_channel_start_time (channel_id, start_time), "
+			"ADD INDEX idx_schedule_channel_end_time (channel_id, end_time), "
+			"ADD INDEX idx_schedule_channel_tag_end_time (channel_id, tag, end_time)"
+		),
+	]),
+	(8, "Add playback_stats table", [
+		(
+			"CREATE TABLE playback_stats ("
+				"id INT NOT NULL AUTO_INCREMENT, "
+				"schedule_id INT DEFAULT NULL, "
+				"media_file_id INT DEFAULT NULL, "
+				"channel_id INT NOT NULL DEFAULT 1, "
+				"encoder VARCHAR(32) DEFAULT NULL, "
+				"started_at DATETIME NOT NULL, "
+				"ended_at DATETIME NOT NULL, "
+				"frames INT NOT NULL DEFAULT 0, "
+				"out_time DOUBLE NOT NULL DEFAULT 0, "
+				"avg_fps DOUBLE DEFAULT NULL, "
+				"avg_speed DOUBLE DEFAULT NULL, "
+				"min_speed DOUBLE DEFAULT NULL, "
+				"slow_samples INT NOT NULL DEFAULT 0, "
+				"dropped_frames INT NOT NULL DEFAULT 0, "
+				"duplicated_frames INT NOT NULL DEFAULT 0, "
+				"avg_bitrate DOUBLE DEFAULT NULL, "
+				"PRIMARY KEY (id), "
+				"INDEX idx_playback_stats_media_file (media_file_id), "
+				"INDEX idx_playback_stats_started_at (started_at), "
+				"CONSTRAINT fk_playback_stats_schedule FOREIGN KEY (schedule_id) REFERENCES schedule (id) ON DELETE SET NULL, "
+				"CONSTRAINT fk_playback_stats_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id) ON DELETE SET NULL"
+			")"
+		),
+	]),
+	(9, "Record the source each mezzanine was made from", [
+		(
+			"ALTER TABLE media_files "
+			"ADD COLUMN transcoded_size BIGINT DEFAULT NULL, "
+			"ADD COLUMN transcoded_mtime DOUBLE DEFAULT NULL"
+		),
+		## Existing mezzanines were made from whatever was last probed
+		(
+			"UPDATE media_files "
+			"INNER JOIN tv_episodes "
+			"ON tv_episodes.media_file_id = media_files.id "
+			"SET media_files.transcoded_size = media_files.size, "
+			"media_files.transcoded_mtime = media_files.mtime "
+			"WHERE tv_episodes.transcoded = 1"
+		),
+	]),
+	(10, "Compare media file paths byte for byte", [
+		## For installs that created media_files before migration 4 set the
+		## collation. A binary collation can't introduce new duplicates
+		"ALTER TABLE media_files MODIFY path VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL",
+	]),
+]
+
+## Queries that run on every schedule build or player loop, shared with the
+## code in lib/queries.py. Each one must be able to use an index on every
+## table it reads
+HOT_QUERIES = [
+	("player current item", ("schedule", "tv_episodes"), PLAYER_CURRENT_ITEM, lambda now: (1, )),
+	("player first upcoming item", ("schedule", "tv_episodes"), PLAYER_FIRST_UPCOMING_ITEM, lambda now: (1, )),
+	("player lookahead window", ("schedule", "tv_episodes"), PLAYER_LOOKAHEAD_WINDOW, lambda now: (1, 1, now, 21)),
+	("schedule tail", ("schedule", ), SCHEDULE_TAIL, lambda now: (1, now)),
+	("previous intermission", ("schedule", ), PREVIOUS_INTERMISSION, lambda now: (1, now)),
+	("item before intermission", ("schedule", ), ITEM_BEFORE_INTERMISSION, lambda now: (1, now)),
+	("items after intermission", ("schedule", ), ITEMS_AFTER_INTERMISSION, lambda now: (1, now, 4)),
+	("future intermissions", ("schedule", ), FUTURE_INTERMISSIONS, lambda now: (now, )),
+	("scheduled media file lookup", ("schedule", ), SCHEDULED_MEDIA_FILE, lambda now: (1, )),
+	("probe cache lookup", ("media_files", ), PROBE_CACHE_LOOKUP, lambda now: ("/", )),
+	("purge chunk", ("schedule", ), PURGE_CHUNK, lambda now: (now, 1000)),
+	("purge archive chunk", ("schedule", "media_files"), PURGE_ARCHIVE_CHUNK, lambda now: (now, 1000)),
+]
+
+class MigrationRunner:
+	def __init__(self, logger=None):
+		self._db = get_mysql_connection()
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def close(self):
+		self._db.close()
+
+	def _ensure_version_table(self, cur):
+		q = (
+			"CREATE TABLE IF NOT EXISTS schema_version ("
+				"version INT NOT NULL, "
+				"description VARCHAR(255) NOT NULL, "
+				"applied_at DATETIME NOT NULL, "
+				"PRIMARY KEY (version)"
+			")"
+		)
+		cur.execute(q)
+
+	def applied_versions(self):
+		cur = self._db.cursor(dictionary=True)
+		self._ensure_version_table(cur)
+		cur.execute("SELECT version FROM schema_version")
+		versions = set(r['version'] for r in cur.fetchall())
+		cur.close()
+		return versions
+
+	def pending(self):
+		applied = self.applied_versions()
+		return [m for m in MIGRATIONS if m[0] not in applied]
+
+	def status(self):
+		applied = self.applied_versions()
+		for version, description, steps in MIGRATIONS:
+			state = "applied" if version in applied else "pending"
+			_print(f"{version:>4} [{state}] {description}", LOG_LEVEL_INFO)
+
+	def migrate(self, dry_run=False):
+		pending = self.pending()
+		if not pending:
+			_print("Database is up to date", LOG_LEVEL_INFO)
+			return 0
+
+		cur = self._db.cursor(dictionary=True)
+		for version, description, steps in pending:
+			_print(f"Applying migration {version}: {description}", LOG_LEVEL_INFO)
+			if dry_run:
+				for step in steps:
+					if callable(step):
+						_print(f"  {step.__name__}()", LOG_LEVEL_INFO)
+					else:
+						_print(f"  {step}", LOG_LEVEL_INFO)
+				continue
+
+			## DDL statements commit implicitly in MySQL, so a migration that
+			## fails part way has to be finished by hand before re-running
+			try:
+				for step in steps:
+					if callable(step):
+						step(cur)
+					else:
+						cur.execute(step)
+
+				q = (
+					"INSERT INTO schema_version "
+					"(version, description, applied_at) "
+					"VALUES (%s, %s, %s)"
+				)
+				cur.execute(q, (version, description, datetime.now()))
+				self._db.commit()
+			except:
+				self._db.rollback()
+				cur.close()
+				_print(f"Migration {version} failed", LOG_LEVEL_ERROR)
+				raise
+
+		cur.close()
+		return len(pending)
+
+	def check_query_plans(self, min_rows=1000):
+		cur = self._db.cursor(dictionary=True)
+		now = datetime.now()
+
+		failures = []
+		for name, tables, query, params in HOT_QUERIES:
+			cur.execute(f"EXPLAIN {query}", params(now))
+			plan = cur.fetchall()
+
+			for row in plan:
+				if row['table'] not in tables or row['type'] != 'ALL':
+					continue
+				## The optimizer prefers a full scan over an index on a tiny
+				## table, which is fine. On anything bigger a scan is a
+				## regression whether or not an index was available
+				if (row['rows'] or 0) < min_rows:
+					_print(f"{name}: full scan on {row['table']} ({row['rows']} rows), table is small", LOG_LEVEL_INFO)
+					continue
+				_print(f"{name}: full scan on {row['table']} ({row['rows']} rows, possible keys: {row['possible_keys']})", LOG_LEVEL_ERROR)
+				failures.append(name)
+				break
+			else:
+				_print(f"{name}: OK", LOG_LEVEL_DEBUG)
+
+		cur.close()
+		return failures
@@ -0,0 +1,306 @@
+import random
+from datetime import datetime, timedelta, time as dttime
+
+from lib.common import Logger
+import config
+from lib.vars import *
+
+_print = Logger()._print
+
+class PlanEntry:
+	__slots__ = (
+		'start_time', 'end_time', 'tag', 'title', 'description', 'path',
+		'media_file_id', 'thumbnail', 'thumbnail_height', 'thumbnail_width',
+		'is_marathon', 'tv_show_id', 'tv_episode_id', 'movie_id'
+	)
+
+	def __init__(self, start_time, end_time, tag, title, description=None,
+		path=None, media_file_id=None, thumbnail=None, thumbnail_height=0,
+		thumbnail_width=0, is_marathon=False, tv_show_id=None,
+		tv_episode_id=None, movie_id=None):
+
+		self.start_time = start_time
+		self.end_time = end_time
+		self.tag = tag
+		self.title = title
+		self.description = description
+		self.path = path
+		self.media_file_id = media_file_id
+		self.thumbnail = thumbnail
+		self.thumbnail_height = thumbnail_height
+		self.thumbnail_width = thumbnail_width
+		self.is_marathon = is_marathon
+		self.tv_show_id = tv_show_id
+		self.tv_episode_id = tv_episode_id
+		self.movie_id = movie_id
+
+	def as_row(self):
+		return (
+			self.start_time,
+			self.end_time,
+			self.is_marathon*1,
+			self.title,
+			self.description,
+			self.media_file_id,
+			self.thumbnail,
+			self.thumbnail_height,
+			self.thumbnail_width,
+			self.tag
+		)
+
+	def __repr__(self):
+		return f"PlanEntry({self.tag} {self.start_time}-{self.end_time} {self.title})"
+
+class Planner:
+	def __init__(self, library, rng=None, logger=None):
+		self.library = library
+		self.rng = rng if rng is not None else random
+		self.sampler = library.sampler(config.SHOW_WEIGHTING, rng=self.rng)
+
+		self.marathon_chance = config.MARATHON_CHANCE
+		self.movie_chance = config.MOVIE_CHANCE
+		self.intermission_interval = config.INTERMISSION_INTERVAL_MINUTES
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def plan_day(self, date, start_time=None, last_intermission=None):
+		if start_time is None:
+			start_time = datetime.combine(date, dttime(0))
+		if last_intermission is None:
+			last_intermission = start_time - timedelta(days=1)
+
+		day_end_time = datetime.combine(date + timedelta(days=1), dttime(0))
+		time_left_in_day = int((day_end_time - start_time).total_seconds())
+
+		marathon_show, marathon_data = self._plan_marathon(time_left_in_day)
+		movies = self._plan_movies(time_left_in_day, marathon_show, marathon_data)
+
+		entries = []
+		total_duration = 0
+		previous_show = None
+		current_show_counter = 0
+		current_show_repeats = 0
+		current_show_id = None
+		in_marathon = False
+		marathon_timer = 0
+		meta = {}
+		while True:
+			if self.intermission_interval > 0:
+				min_since_intermission = ((start_time + timedelta(seconds=total_duration)) - last_intermission).total_seconds() / 60.0
+				if min_since_intermission > self.intermission_interval:
+					intermission_start_time = start_time + timedelta(seconds=total_duration)
+					intermission_end_time = start_time + timedelta(seconds=(total_duration + 180))
+					entries.append(PlanEntry(
+						intermission_start_time,
+						intermission_end_time,
+						'INTERMISSION',
+						'Intermission'
+					))
+					total_duration += 180
+					last_intermission = start_time + timedelta(seconds=(total_duration + 180))
+					_print(f"[INTERMISSION] {intermission_start_time}-{intermission_end_time}", LOG_LEVEL_DEBUG)
+
+			if current_show_id is None or current_show_counter >= current_show_repeats and not in_marathon:
+				current_show_counter = 0
+				current_show_repeats = 0
+				show = self._pick_show(previous_show, marathon_show)
+				if show is None:
+					_print(f"No enabled shows with episodes to schedule for {date}", LOG_LEVEL_ERROR)
+					break
+				current_show_id = show['id']
+				meta = {
+					'show_name': show['title'],
+					'title': 'Unknown',
+					'description': 'No Description',
+					'thumbnail': show['thumbnail'],
+					'thumbnail_height': show['thumbnail_height'],
+					'thumbnail_width': show['thumbnail_width']
+				}
+			elif in_marathon:
+				current_show_id = marathon_show['id']
+				meta['show_name'] = marathon_show['title']
+				meta['thumbnail'] = marathon_show['thumbnail']
+				meta['thumbnail_height'] = marathon_show['thumbnail_height']
+				meta['thumbnail_width'] = marathon_show['thumbnail_width']
+
+			next_episode = self.library.episodes.peek(current_show_id)
+			if not next_episode:
+				current_show_counter = 0
+				current_show_repeats = 0
+				continue
+
+			## See if we entered MARATHON TIME
+			if (marathon_show is not None
+				and total_duration + next_episode['duration'] > marathon_data['start']
+				and not in_marathon
+				and marathon_timer == 0):
+
+				in_marathon = True
+				current_show_counter = 0
+				current_show_repeats = 0
+				continue
+
+			## See if we should be playing a movie
+			movie_added = False
+			for movie in movies:
+				if movie['scheduled']:
+					continue
+				if total_duration + next_episode['duration'] > movie['start_time']:
+					movie_start_time = start_time + timedelta(seconds=total_duration)
+					movie_end_time = start_time + timedelta(seconds=(total_duration + movie['movie']['duration']))
+					entries.append(PlanEntry(
+						movie_start_time,
+						movie_end_time,
+						'MOVIE',
+						movie['movie']['title'],
+						description=movie['movie']['description'],
+						path=movie['movie']['path'],
+						thumbnail=movie['movie']['thumbnail'],
+						thumbnail_height=movie['movie']['thumbnail_height'],
+						thumbnail_width=movie['movie']['thumbnail_width'],
+						movie_id=movie['movie']['id']
+					))
+
+					total_duration += movie['movie']['duration']
+					movie['scheduled'] = True
+					movie_added = True
+					_print(f"[MOVIE] {movie_start_time}-{movie_end_time} {movie['movie']['title']}", LOG_LEVEL_DEBUG)
+					break
+			if movie_added:
+				continue
+
+			## If we are in a marathon and this one exceeds the timer, go back to normal
+			if in_marathon and marathon_timer + next_episode['duration'] > marathon_data['duration']:
+				in_marathon = False
+				continue
+
+			meta['description'] = next_episode['description']
+
+			if current_show_counter >= current_show_repeats:
+				current_show_counter = 0
+				## Allow more repeats of shorter shows
+				if next_episode['duration'] > 1800:
+					possible_repeats = [2]
+				else:
+					possible_repeats = [2,4]
+
+				if self.rng.random() < 0.4:
+					current_show_repeats = possible_repeats[self.rng.randint(0, len(possible_repeats)-1)]
+				else:
+					current_show_repeats = 0
+
+			episode_start_time = start_time + timedelta(seconds=total_duration)
+			episode_end_time = start_time + timedelta(seconds=(total_duration + next_episode['duration']))
+
+			previous_show = next_episode['tv_show_id']
+			current_show_counter += 1
+			total_duration += next_episode['duration']
+
+			if in_marathon:
+				marathon_timer += next_episode['duration']
+				meta['title'] = f"{meta['show_name']} Marathon! S{next_episode['season_number']} E{next_episode['episode_number']}"
+			else:
+				meta['title'] = f"{meta['show_name']} S{next_episode['season_number']} E{next_episode['episode_number']}"
+
+			entries.append(PlanEntry(
+				episode_start_time,
+				episode_end_time,
+				'TV_MARATHON' if in_marathon else 'TV_EPISODE',
+				meta['title'],
+				description=meta['description'],
+				path=next_episode['path'],
+				media_file_id=next_episode['media_file_id'],
+				thumbnail=meta['thumbnail'],
+				thumbnail_height=meta['thumbnail_height'],
+				thumbnail_width=meta['thumbnail_width'],
+				is_marathon=in_marathon,
+				tv_show_id=next_episode['tv_show_id'],
+				tv_episode_id=next_episode['id']
+			))
+			self.library.episodes.advance(next_episode['tv_show_id'])
+
+			if not in_marathon:
+				_print(f"[TV SHOW] {episode_start_time}-{episode_end_time} {meta['title']}", LOG_LEVEL_DEBUG)
+			else:
+				_print(f"[MARATHON] {episode_start_time}-{episode_end_time} {meta['title']}", LOG_LEVEL_DEBUG)
+
+			if episode_end_time.date() > date:
+				break
+
+		return entries
+
+	def _plan_marathon(self, time_left_in_day):
+		if self.rng.random() > self.marathon_chance:
+			return None, {}
+
+		## All shows that have >= 20h of content
+		candidates = self.library.marathon_shows(72000)
+		if not candidates:
+			return None, {}
+		marathon_show = self.library.shows[self.rng.choice(candidates)]
+
+		## Make sure we have at least 8 hours of open schedule this day
+		if time_left_in_day < 28800:
+			return None, {}
+
+		## Max duration is 12 hours unless that much time isn't left in the day
+		max_duration = min(time_left_in_day, 43200)
+		## Duration is 8-12 hours
+		marathon_duration = self.rng.randint(28800, max_duration)
+		## Start the marathon with enough time left in the day
+		marathon_start = self.rng.randint(0, time_left_in_day - marathon_duration)
+
+		return marathon_show, {
+			'start': marathon_start,
+			'duration': marathon_duration
+		}
+
+	def _plan_movies(self, time_left_in_day, marathon_show, marathon_data):
+		movies = []
+		if self.rng.random() > self.movie_chance or not self.library.movies:
+			return movies
+
+		movie = self.rng.choice(self.library.movies)
+
+		movie_start = None
+		if marathon_show is not None:
+			time_before = marathon_data['start']
+			time_after = time_left_in_day - time_before - marathon_data['duration']
+			marathon_end = marathon_data['start'] + marathon_data['duration']
+
+			if time_before > movie['duration'] and time_after > movie['duration']:
+				if self.rng.random() >= 0.5:
+					movie_start = self.rng.randint(0, time_before - movie['duration'])
+				else:
+					movie_start = self.rng.randint(marathon_end, time_left_in_day - movie['duration'])
+			elif time_before > movie['duration']:
+				movie_start = self.rng.randint(0, time_before - movie['duration'])
+			elif time_after > movie['duration']:
+				movie_start = self.rng.randint(marathon_end, time_left_in_day - movie['duration'])
+			else:
+				_print("No time in day for movie (marathon day)", LOG_LEVEL_INFO)
+		else:
+			if time_left_in_day > movie['duration']:
+				movie_start = self.rng.randint(0, time_left_in_day - movie['duration'])
+			else:
+				_print("No time in day for movie", LOG_LEVEL_INFO)
+
+		if movie_start is not None:
+			movies.append({
+				'movie': movie,
+				'start_time': movie_start,
+				'scheduled': False
+			})
+		return movies
+
+	def _pick_show(self, previous_show, marathon_show):
+		marathon_id = marathon_show['id'] if marathon_show is not None else None
+
+		## Relax the exclusions if the library is too small to honour them
+		for exclude in ((previous_show, marathon_id), (marathon_id, ), ()):
+			show_id = self.sampler.pick(exclude)
+			if show_id is not None:
+				return self.library.shows[show_id]
+		return None
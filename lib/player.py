@@ -4,9 +4,17 @@ import os, sys, signal
 import subprocess
 import threading
 import queue
-import json
-
-from lib.common import get_mysql_connection, Logger
+import mysql.connector
+
+from lib.common import get_mysql_connection, update_by_id, Logger
+from lib.probe import ProbeCache, get_audio_track, get_video_track
+from lib.prefetch import Prefetcher
+from lib.transcoder import mezzanine_path, source_matches
+from lib.encoders import get_backend
+from lib.filtergraph import FilterPlan
+from lib.channels import get_channels
+from lib.progress import ProgressReader
+from lib.queries import PLAYER_CURRENT_ITEM, PLAYER_FIRST_UPCOMING_ITEM, PLAYER_LOOKAHEAD_WINDOW
 from lib.vars import *
 import config
 
@@ -14,24 +22,103 @@ _print = Logger()._print
 
 OVERLAY_FONT = os.path.join(config.INTERMISSION_RESOURCE_PATH, 'fonts/SairaCondensed-Regular.ttf')
 OVERLAY_FONT_BOLD = os.path.join(config.INTERMISSION_RESOURCE_PATH, 'fonts/SairaCondensed-SemiBold.ttf')
+## Live encodes and mezzanines are all 30000/1001
+FRAME_DURATION = 1001 / 30000
+class ContinuousOutput:
+	def __init__(self, rtmp_post):
+		self.rtmp_post = rtmp_post
+		self._process = None
+		self._started = None
+		self._offset = 0.0
+
+	def start(self):
+		## Single long lived muxer that owns the RTMP connection. Each item
+		## is encoded to MPEG-TS and written into this process' stdin
+		ffmpeg_params = [
+			config.FFMPEG_PATH,
+			'-hide_banner',
+			'-fflags', '+genpts+igndts',
+			'-f', 'mpegts',
+			'-i', 'pipe:0',
+			'-c', 'copy',
+			'-f', 'flv',
+			self.rtmp_post
+		]
+		_print(f"Starting continuous output to {self.rtmp_post}", LOG_LEVEL_INFO)
+		self._process = subprocess.Popen(
+			ffmpeg_params,
+			stdin=subprocess.PIPE,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL
+		)
+		self._started = time.monotonic()
+		self._offset = 0.0
+
+	def ensure_running(self):
+		if self._process is None or self._process.poll() is not None:
+			if self._process is not None:
+				_print(f"Continuous output exited ({self._process.returncode}), reconnecting", LOG_LEVEL_ERROR)
+			self.start()
+
+	@property
+	def stdin(self):
+		return self._process.stdin
+
+	def next_offset(self, waited=False):
+		## Each item picks up where the previous one's timestamps ended, so
+		## the time spent starting the next ffmpeg doesn't show up as a
+		## freeze. After a scheduled gap the stream jumps to real time
+		if waited:
+			self._offset = max(self._offset, time.monotonic() - self._started)
+		return self._offset
+
+	def advance(self, duration):
+		## out_time is the last timestamp written, so the next item starts
+		## one frame after it
+		if duration:
+			self._offset += duration + FRAME_DURATION
+
+	def stop(self):
+		if self._process is None:
+			return
+		try:
+			self._process.stdin.close()
+		except OSError:
+			pass
+		try:
+			self._process.wait(timeout=10)
+		except subprocess.TimeoutExpired:
+			self._process.terminate()
+		self._process = None
+
 class PlayerThread(threading.Thread):
-	def __init__(self, playlist_queue, completed_queue):
+	def __init__(self, playlist_queue, completed_queue, prefetcher=None, rtmp_post=None, encoder=None, logger=None):
 		threading.Thread.__init__(self)
 
 		self.playlist_queue = playlist_queue
 		self.completed_queue = completed_queue
+		self.prefetcher = prefetcher
+		self.rtmp_post = rtmp_post if rtmp_post is not None else config.RTMP_POST
 
 		self._keep_listening = True
+		self._stop_event = threading.Event()
 		self._ffmpeg_process = None
+		self._encoder = encoder if encoder is not None else get_backend()
+		self._copy = get_backend('copy')
+		self._output = None
+		if config.CONTINUOUS_OUTPUT:
+			self._output = ContinuousOutput(self.rtmp_post)
+		self._logger = logger
 	
 	def run(self):
 		while self._keep_listening:
-			try:
-				to_play = self.playlist_queue.get(timeout=5)
-			except queue.Empty:
-				_print('Queue is empty', LOG_LEVEL_ERROR)
-				continue
+			## Blocks until the player queues the next item. None is put on
+			## the queue by stop() to wake the thread up
+			to_play = self.playlist_queue.get()
+			if to_play is None:
+				break
 
+			offset = None
 			if to_play.get('schedule_start_time', None) is not None:
 				_print(f"Scheduled start time: {to_play['schedule_start_time']}", LOG_LEVEL_DEBUG)
 				offset = (to_play['schedule_start_time'] - datetime.now()).total_seconds()
@@ -41,172 +128,276 @@ class PlayerThread(threading.Thread):
 					_print("Something is likely wrong", LOG_LEVEL_ERROR)
 					_print("Waiting until scheduled time to resume", LOG_LEVEL_ERROR)
 					to_play['wait_until'] = to_play['schedule_start_time']
-			
-			inputs = 0
-			ffmpeg_params = [
-				config.FFMPEG_PATH,
-				'-hwaccel_output_format', 'cuda',
-				'-re'
-			]
-			if to_play.get('skipto', None):
-				ffmpeg_params += [
-					'-ss', str(to_play['skipto'])
-				]
-			
-			ffmpeg_params += ['-i', to_play['path']]
-			inputs += 1
-
-			filters = (
-				f'[0:v:{to_play.get("video_track", "0")}]scale=1920:1080:force_original_aspect_ratio=decrease[v],'
-				'[v]pad=1920:1080:(ow-iw)/2:(oh-ih)/2[v],'
-				'[v]setsar=1[v],'
-				'[v]format=yuv420p[v]'
-			)
-
-			if config.WATERMARK:
-				ffmpeg_params += ['-i', config.WATERMARK]
-				inputs += 1
-				input_index = inputs - 1
-				filters += (
-					f',[{input_index}:v]format=rgba,colorchannelmixer=aa=0.5[overlay],'
-					'[v][overlay]overlay=(main_w-overlay_w)-30:(main_h-overlay_h)-30[v]'
-				)
-			
-			if to_play.get('tag') == 'INTERMISSION':
-				duration = int((to_play['schedule_end_time'] - to_play['schedule_start_time']).total_seconds())
-				if offset:
-					duration += offset
-					if duration < 60:
-						duration = 60
-				if to_play.get('skipto'):
-					duration = duration - int(to_play['skipto'])
-				countdown_input = (
-					f'color=color=#00000000@0:size=550x150:duration={duration},'
-					"format=rgba,"
-					"drawtext="
-						f"fontfile={OVERLAY_FONT_BOLD}:"
-						"fontsize=90:"
-						"fontcolor=white:"
-						f"text='%{{eif\:({duration}-t)/60\:d\:1}}\:%{{eif\:mod({duration}-t,60)\:d\:2}}':"
-						"x=(w-text_w)/2:y=(h-text_h)"
-				)
-				ffmpeg_params += [
-					'-f', 'lavfi', 
-					'-i', countdown_input
-				]
-				inputs += 1
-
-				input_index = inputs - 1
-				filters += (
-					f',[v][{input_index}]overlay=0:(main_h-150-30)[v]'
-				)
 
-			
-			if (to_play.get('tag') == 'INTERMISSION' 
-				and to_play.get('skipto') is None 
-				and to_play.get('wait_until') is None 
-				and offset):
-				intermission_time = 180 + offset
-				if intermission_time < 60:
-					intermission_time = 60
-				ffmpeg_params += ['-t', str(intermission_time)]
-				_print(f'Using intermission to adjust schedule. Intermission time set to {intermission_time}s', LOG_LEVEL_DEBUG)
-			
+			ffmpeg_params = self._build_ffmpeg_params(to_play, offset)
+			## Machine readable progress on stderr instead of the usual
+			## status line, for the reader thread below
 			ffmpeg_params += [
-				'-c:v', 'h264_nvenc',
-				'-filter_complex', filters,
-				'-pix_fmt', 'yuv420p',
-				'-r', '30000/1001',
-				'-c:a', 'aac',
-				'-ar', '44100',
-				'-b:a', "256k",
-				'-ac', "1",
-				'-map', '[v]',
-				'-map', f"0:{to_play.get('audio_track', '1')}",
-				'-f', 'flv',
-				config.RTMP_POST
+				'-progress', 'pipe:2',
+				'-nostats',
+				'-v', 'error'
 			]
 
+			waited = False
 			if to_play.get('wait_until', None) is not None:
 				now = datetime.now()
 				if to_play['wait_until'] > now:
 					seconds_to_wait = (to_play['wait_until'] - now).total_seconds()
 					_print(f"Thread was told to wait for {seconds_to_wait}s", LOG_LEVEL_INFO)
-					time.sleep(seconds_to_wait)
+					if self._stop_event.wait(seconds_to_wait):
+						break
+					waited = True
 
+			if self._output is not None:
+				self._output.ensure_running()
+				ffmpeg_params += [
+					'-f', 'mpegts',
+					'-flush_packets', '1',
+					'-output_ts_offset', f"{self._output.next_offset(waited):.3f}",
+					'pipe:1'
+				]
+				stdout = self._output.stdin
+			else:
+				ffmpeg_params += [
+					'-f', 'flv',
+					self.rtmp_post
+				]
+				stdout = subprocess.DEVNULL
+
+			started_at = datetime.now()
 			self.completed_queue.put({
 				'id': to_play['id'],
-				'start_time': datetime.now()
+				'start_time': started_at
 			})
 			
+			if self.prefetcher is not None:
+				self.prefetcher.claim(to_play['path'])
 			_print(f"Playing {to_play['path']}", LOG_LEVEL_INFO)
 			self._ffmpeg_process = subprocess.Popen(
 				ffmpeg_params, 
-				stdout=subprocess.DEVNULL, 
-				stderr=subprocess.STDOUT
+				stdout=stdout, 
+				stderr=subprocess.PIPE
 			)
 			#self._ffmpeg_process = subprocess.Popen(ffmpeg_params)
-			while self._ffmpeg_process.poll() is None:
-				time.sleep(1)
+			progress = ProgressReader(self._ffmpeg_process.stderr, to_play['path'], logger=self._logger)
+			progress.start()
+			if not self._keep_listening:
+				self._ffmpeg_process.terminate()
+			self._ffmpeg_process.wait()
+			progress.join(timeout=5)
+			if self._output is not None:
+				self._output.advance(progress.out_time)
 
 			self._ffmpeg_process = None
 			if self._keep_listening:
+				stats = progress.summary()
+				stats['media_file_id'] = to_play.get('media_file_id')
+				stats['encoder'] = self._copy.name if to_play.get('transcoded') else self._encoder.name
+				stats['started_at'] = started_at
 				self.completed_queue.put({
 					'id': to_play['id'],
-					'end_time': datetime.now()
+					'end_time': datetime.now(),
+					'stats': stats
 				})
+
+		if self._output is not None:
+			self._output.stop()
+
+	def _build_ffmpeg_params(self, to_play, offset):
+		if to_play.get('transcoded'):
+			return self._build_copy_params(to_play)
+
+		plan = FilterPlan(
+			to_play.get('probe'),
+			to_play.get('video_track', 0),
+			to_play.get('audio_track', 1)
+		)
+		filters, label = plan.video_chain()
+		overlays = config.WATERMARK or to_play.get('tag') == 'INTERMISSION'
+
+		## With nothing to filter, decoded frames can go straight to the
+		## encoder without leaving the GPU
+		inputs = 0
+		ffmpeg_params = [
+			config.FFMPEG_PATH
+		] + self._encoder.input_args(hw_frames=not filters and not overlays) + [
+			'-re'
+		]
+		if to_play.get('skipto', None):
+			ffmpeg_params += [
+				'-ss', str(to_play['skipto'])
+			]
+		
+		ffmpeg_params += ['-i', to_play['path']]
+		inputs += 1
+
+		if config.WATERMARK:
+			ffmpeg_params += ['-i', config.WATERMARK]
+			inputs += 1
+			input_index = inputs - 1
+			filters += [
+				f'[{input_index}:v]format=rgba,colorchannelmixer=aa=0.5[overlay]',
+				f'[{label}][overlay]overlay=(main_w-overlay_w)-30:(main_h-overlay_h)-30[v]'
+			]
+			label = 'v'
+		
+		if to_play.get('tag') == 'INTERMISSION':
+			duration = int((to_play['schedule_end_time'] - to_play['schedule_start_time']).total_seconds())
+			if offset:
+				duration += offset
+				if duration < 60:
+					duration = 60
+			if to_play.get('skipto'):
+				duration = duration - int(to_play['skipto'])
+			countdown_input = (
+				f'color=color=#00000000@0:size=550x150:duration={duration},'
+				"format=rgba,"
+				"drawtext="
+					f"fontfile={OVERLAY_FONT_BOLD}:"
+					"fontsize=90:"
+					"fontcolor=white:"
+					f"text='%{{eif\\:({duration}-t)/60\\:d\\:1}}\\:%{{eif\\:mod({duration}-t,60)\\:d\\:2}}':"
+					"x=(w-text_w)/2:y=(h-text_h)"
+			)
+			ffmpeg_params += [
+				'-f', 'lavfi', 
+				'-i', countdown_input
+			]
+			inputs += 1
+
+			input_index = inputs - 1
+			filters += [
+				f'[{label}][{input_index}]overlay=0:(main_h-150-30)[v]'
+			]
+			label = 'v'
+
+		
+		if (to_play.get('tag') == 'INTERMISSION' 
+			and to_play.get('skipto') is None 
+			and to_play.get('wait_until') is None 
+			and offset):
+			intermission_time = 180 + offset
+			if intermission_time < 60:
+				intermission_time = 60
+			ffmpeg_params += ['-t', str(intermission_time)]
+			_print(f'Using intermission to adjust schedule. Intermission time set to {intermission_time}s', LOG_LEVEL_DEBUG)
+		
+		ffmpeg_params += self._encoder.output_args()
+		if filters:
+			ffmpeg_params += [
+				'-filter_complex', ','.join(filters),
+				'-map', f'[{label}]'
+			]
+		else:
+			ffmpeg_params += ['-map', label]
+		if plan.converts_pix_fmt:
+			ffmpeg_params += ['-pix_fmt', 'yuv420p']
+		ffmpeg_params += [
+			'-r', '30000/1001',
+			'-c:a', 'aac',
+			'-b:a', "256k"
+		] + plan.audio_args + [
+			'-map', f"0:{to_play.get('audio_track', '1')}"
+		]
+		return ffmpeg_params
+
+	def _build_copy_params(self, to_play):
+		ffmpeg_params = [
+			config.FFMPEG_PATH,
+			'-re'
+		]
+		if to_play.get('skipto', None):
+			ffmpeg_params += [
+				'-ss', str(to_play['skipto'])
+			]
+		ffmpeg_params += [
+			'-i', to_play['path'],
+			'-map', '0:v:0',
+			'-map', '0:a:0'
+		] + self._copy.output_args() + [
+			'-c:a', 'copy'
+		]
+		return ffmpeg_params
 		
 	def stop(self):
 		self._keep_listening = False
+		self._stop_event.set()
+		self.playlist_queue.put(None)
 		if self._ffmpeg_process is not None:
 			_print("Terminating ffmpeg process", LOG_LEVEL_DEBUG)
 			self._ffmpeg_process.terminate()
 
 class Player:
-	def __init__(self, logger=None):
+	def __init__(self, logger=None, channel=None):
+		self.channel = channel if channel is not None else get_channels()[0]
+		self._logger = logger
+		self._stop_event = threading.Event()
+		self._completed_queue = queue.Queue()
+
+		## One connection for the lifetime of the player, shared with the
+		## probe cache and pinged back to life before each use
+		self._db = get_mysql_connection()
+		## A connection held open this long would otherwise keep reading
+		## the InnoDB snapshot from its first SELECT until something
+		## commits, and never see schedule rows added after that. The
+		## setting is reapplied when ping() reconnects
+		self._db.autocommit = True
+		self._probe_cache = ProbeCache(self._db, logger=logger)
+		self._prefetcher = Prefetcher(logger=logger)
+		## Start/end events that haven't made it to the database yet
+		self._pending_status = []
+		## Upcoming schedule rows, reloaded when schedule_revision moves or
+		## the window runs low
+		self._window = []
+		self._window_size = config.PLAYER_LOOKAHEAD
+		self._revision = None
+
 		if logger is not None:
 			global _print
 			_print = logger._print
+
+		## Calibration can take several seconds per encoder. Do it before
+		## play() picks the start item and works out the skipto, otherwise
+		## the first item starts that much later than scheduled
+		self._encoder = get_backend(logger=logger)
 	
 	def close(self):
-		pass
+		self._probe_cache.close()
+		self._db.close()
+
+	def _connection(self):
+		self._db.ping(reconnect=True, attempts=3, delay=1)
+		return self._db
+
+	def stop(self):
+		self._stop_event.set()
+		## Wake up the main loop if it is waiting on the player thread
+		self._completed_queue.put(None)
 	
 	def play(self):
-		db = get_mysql_connection()
+		db = self._connection()
 		cur = db.cursor(dictionary=True)
 		playlist_queue = queue.Queue()
-		completed_queue = queue.Queue()
+		completed_queue = self._completed_queue
 
-		q = (
-			"SELECT * FROM schedule "
-			"WHERE start_time <= NOW() "
-			"AND end_time > NOW() "
-			"AND path IS NOT NULL "
-			"ORDER BY start_time "
-			"LIMIT 1"
-		)
-		cur.execute(q)
+		cur.execute(PLAYER_CURRENT_ITEM, (self.channel.id, ))
 		starting_schedule = cur.fetchone()
 
 		if not starting_schedule:
-			q = (
-				"SELECT * FROM schedule "
-				"WHERE start_time >= NOW() "
-				"AND path IS NOT NULL "
-				"ORDER BY start_time "
-				"LIMIT 1"
-			)
-			cur.execute(q)
+			cur.execute(PLAYER_FIRST_UPCOMING_ITEM, (self.channel.id, ))
 			starting_schedule = cur.fetchone()
 			if not starting_schedule:
-				_print("Nothing exists in schedule", LOG_LEVEL_ERROR)
+				_print(f"Nothing exists in schedule for channel {self.channel.number}", LOG_LEVEL_ERROR)
+				cur.close()
 				return
 			now = datetime.now()
 
 			if now < starting_schedule['start_time']:
 				to_wait = (starting_schedule['start_time'] - now).total_seconds()
-				_print(f"Waiting for {to_wait}s for next scheduled show", LOG_LEVEL_INFO)
-				time.sleep(to_wait)
+				_print(f"Waiting for {to_wait}s for next scheduled show on channel {self.channel.number}", LOG_LEVEL_INFO)
+				if self._stop_event.wait(to_wait):
+					cur.close()
+					return
 
 		skipto = None
 		if starting_schedule['start_time'] < datetime.now():
@@ -216,173 +407,257 @@ class Player:
 
 		_print(f"Skipping {skipto}s of first show", LOG_LEVEL_DEBUG)
 
-		playlist_queue.put({
-			'id': starting_schedule['id'],
-			'path': starting_schedule['path'],
-			'schedule_start_time': starting_schedule['start_time'],
-			'schedule_end_time': starting_schedule['end_time'],
-			'skipto': skipto,
-			'tag': starting_schedule['tag'],
-			'audio_track': self._get_audio_track(starting_schedule['path']),
-			'video_track': self._get_video_track(starting_schedule['path'])
-		})
-
-		pt = PlayerThread(playlist_queue, completed_queue)
+		to_play = self._playlist_item(starting_schedule)
+		to_play['skipto'] = skipto
+		playlist_queue.put(to_play)
+		duration = (starting_schedule['end_time'] - starting_schedule['start_time']).total_seconds()
+		self._prefetcher.prefetch(to_play['path'], skipto, duration)
+
+		pt = PlayerThread(
+			playlist_queue,
+			completed_queue,
+			self._prefetcher,
+			self.channel.rtmp_post,
+			self._encoder,
+			logger=self._logger
+		)
 		pt.start()
 
 		previous_played = starting_schedule
 		cur.close()
-		db.close()
+
+		## The thread sends a start event as soon as it takes an item off the
+		## playlist queue, which is the cue to queue up the one after it
+		queue_next = False
+		while not self._stop_event.is_set():
+			try:
+				try:
+					## Only wake up on a timer while something needs retrying
+					retry = queue_next or self._pending_status
+					completed = completed_queue.get(timeout=10 if retry else None)
+				except queue.Empty:
+					completed = None
+
+				if completed is not None:
+					## None is only put there by stop()
+					events = [e for e in [completed] + self._drain(completed_queue) if e is not None]
+					self._pending_status += events
+					if any(e.get('start_time') is not None for e in events):
+						queue_next = True
+
+				## Queue the next item before touching the status rows so a
+				## slow database write can't hold up playback
+				if queue_next:
+					next_schedule = self._queue_next(playlist_queue, previous_played)
+					if next_schedule is not None:
+						previous_played = next_schedule
+						queue_next = False
+
+				self._flush_status()
+			except KeyboardInterrupt:
+				break
+
+		pt.stop()
+		pt.join()
+		self._flush_status()
+
+	def _refresh_window(self, previous_played):
+		cur = self._connection().cursor(dictionary=True)
+		cur.execute("SELECT revision FROM schedule_revision WHERE id = 1")
+		row = cur.fetchone()
+		revision = row['revision'] if row else None
+
+		if revision == self._revision and len(self._window) > self._window_size // 2:
+			cur.close()
+			return
+
+		cur.execute(PLAYER_LOOKAHEAD_WINDOW, (
+			self.channel.id,
+			previous_played['id'],
+			previous_played['start_time'],
+			self._window_size + 1
+		))
+		self._window = cur.fetchall()
+		self._revision = revision
+		cur.close()
+		_print(f"Loaded {len(self._window)} upcoming items (revision {revision})", LOG_LEVEL_DEBUG)
+
+	def _queue_next(self, playlist_queue, previous_played):
+		try:
+			self._refresh_window(previous_played)
+		except mysql.connector.Error as e:
+			## Keep playing from what we already have
+			_print(f"Could not refresh upcoming items, using {len(self._window)} cached: {e}", LOG_LEVEL_ERROR)
+
+		## Drop everything up to the queued item by id. Its start time may
+		## have moved since it was queued, so comparing times could let it
+		## through again. A reload also brings its current end time
+		previous_index = next((i for i, s in enumerate(self._window) if s['id'] == previous_played['id']), None)
+		if previous_index is not None:
+			previous_played = self._window[previous_index]
+			del self._window[:previous_index + 1]
+		else:
+			## Already popped, or removed from the schedule
+			while self._window and self._window[0]['start_time'] <= previous_played['start_time']:
+				self._window.pop(0)
+
+		if not self._window:
+			## Tried again once the completed queue wait times out
+			_print("Nothing in schedule", LOG_LEVEL_ERROR)
+			return None
+		next_schedule = self._window.pop(0)
+
+		to_play = self._playlist_item(next_schedule)
+		if next_schedule['start_time'] != previous_played['end_time']:
+			to_play['wait_until'] = next_schedule['start_time']
+
+		_print(f"Adding {to_play['path']} to the queue", LOG_LEVEL_DEBUG)
+		playlist_queue.put(to_play)
+		## Warm the page cache while the current item is still playing
+		self._prefetcher.prefetch(to_play['path'])
+		return next_schedule
+
+	def _playlist_item(self, schedule):
+		to_play = {
+			'id': schedule['id'],
+			'media_file_id': schedule['media_file_id'],
+			'path': schedule['path'],
+			'schedule_start_time': schedule['start_time'],
+			'schedule_end_time': schedule['end_time'],
+			'tag': schedule['tag'],
+			'transcoded': False
+		}
+
+		## Mezzanines are already normalized, so they only need copying
+		if config.TRANSCODE_PATH and schedule.get('transcoded'):
+			mezzanine = mezzanine_path(schedule['media_file_id'])
+			if not source_matches(schedule['path'], schedule.get('transcoded_size'), schedule.get('transcoded_mtime')):
+				_print(f"{schedule['path']} changed since it was transcoded, encoding live", LOG_LEVEL_ERROR)
+			elif os.path.exists(mezzanine):
+				to_play['path'] = mezzanine
+				to_play['transcoded'] = True
+				return to_play
+			else:
+				_print(f"Mezzanine missing for {schedule['path']}, encoding live", LOG_LEVEL_ERROR)
+
+		probe = self._probe(schedule['path'])
+		to_play['probe'] = probe
+		to_play['audio_track'] = get_audio_track(probe, schedule['path'])
+		to_play['video_track'] = get_video_track(probe, schedule['path'])
+		return to_play
+
+	def _probe(self, file_path):
+		try:
+			return self._probe_cache.get(file_path)
+		except mysql.connector.Error:
+			## Database is down, ask ffprobe directly
+			return self._probe_cache.probe(file_path)
+
+	def _drain(self, completed_queue):
+		events = []
 		while True:
 			try:
-				if not completed_queue.empty():
-					self._handle_completed(completed_queue)
-				if not playlist_queue.empty():
-					time.sleep(5)
-					continue
-				
-				db = get_mysql_connection()
-				cur = db.cursor(dictionary=True)
-				
-				q = (
-					"SELECT * FROM schedule "
-					"WHERE start_time > "
-						"(SELECT start_time FROM schedule WHERE id = %s) "
-					"AND path IS NOT NULL "
-					"ORDER BY start_time "
-					"LIMIT 1"
-				)
-				cur.execute(q, (previous_played['id'], ))
-				next_schedule = cur.fetchone()
-
-				if not next_schedule:
-					_print("Nothing in schedule", LOG_LEVEL_ERROR)
-					time.sleep(10)
-					continue
-				
-				wait_until = None
-				if next_schedule['start_time'] != previous_played['end_time']:
-					wait_until = next_schedule['start_time']
-
-				_print(f"Adding {next_schedule['path']} to the queue", LOG_LEVEL_DEBUG)
-				playlist_queue.put({
-					'id': next_schedule['id'],
-					'path': next_schedule['path'],
-					'schedule_start_time': next_schedule['start_time'],
-					'schedule_end_time': next_schedule['end_time'],
-					'wait_until': wait_until,
-					'tag': next_schedule['tag'],
-					'audio_track': self._get_audio_track(next_schedule['path']),
-					'video_track': self._get_video_track(next_schedule['path'])
-				})
-				previous_played = next_schedule
+				events.append(completed_queue.get(block=False))
+			except queue.Empty:
+				return events
+
+	def _flush_status(self):
+		if not self._pending_status:
+			return
+
+		starts = [e for e in self._pending_status if e.get('start_time') is not None]
+		ends = [e for e in self._pending_status if e.get('end_time') is not None]
+		stats = [e for e in ends if e.get('stats') is not None]
+		try:
+			db = self._connection()
+			cur = db.cursor()
+			## Autocommit is on, so group the batch into one transaction
+			db.start_transaction()
+			## One UPDATE per kind of event. Starts go first so an item that
+			## started and finished within one drain ends up completed
+			if starts:
+				self._update_status(cur, 'actual_start_time', 'start_time', 0, starts)
+			if ends:
+				self._update_status(cur, 'actual_end_time', 'end_time', 1, ends)
+			if stats:
+				self._insert_stats(cur, stats)
+			self._db.commit()
+			cur.close()
+		except mysql.connector.Error as e:
+			## Keep the events and retry on the next drain
+			_print(f"Could not write {len(self._pending_status)} status updates: {e}", LOG_LEVEL_ERROR)
+			try:
+				self._db.rollback()
+			except mysql.connector.Error:
+				pass
+			return
 
-				cur.close()
-				db.close()
-			except KeyboardInterrupt:
-				pt.stop()
-				sys.exit(0)
-
-	def _get_audio_track(self, file_path):
-		ffprobe_params = [
-			config.FFPROBE_PATH,
-			'-hide_banner', '-show_streams',
-			'-print_format', 'json',
-			file_path
-		]
-		process = subprocess.Popen(
-			ffprobe_params, 
-			stdout=subprocess.PIPE,
-			stderr=subprocess.PIPE
-		)
+		_print(f"Wrote {len(starts)} start and {len(ends)} end times", LOG_LEVEL_DEBUG)
+		self._pending_status = []
 
-		#process.wait()
-		data, err = process.communicate()
-		#print(data)
-		audio_tracks = []
-		preferred_lang_tracks = []
-		if process.returncode == 0:
-			output = json.loads(data.decode('utf-8'))
-
-			for stream in output.get('streams', []):
-				if stream.get('codec_type') != 'audio':
-					continue
-				audio_tracks.append(stream['index'])
-				if stream.get('tags', {}).get('language', '').lower() == config.AUDIO_LANG:
-					if stream.get('codec_name') in ['dts', 'ac3', 'aac']:
-						_print(f"Found {stream['codec_name']} {config.AUDIO_LANG} audio track for {file_path} ({stream['index']})", LOG_LEVEL_DEBUG)
-						return stream['index']
-					preferred_lang_tracks.append(stream)
-		
-		if len(preferred_lang_tracks) > 0:
-			_print("No ac3/aac audio track found. Using first track for preferred language:", LOG_LEVEL_DEBUG)
-			_print(f"  codec: {preferred_lang_tracks[0]['codec_name']} track: {preferred_lang_tracks[0]['index']}", LOG_LEVEL_DEBUG)
-			return preferred_lang_tracks[0]['index']
-		
-		if len(audio_tracks) > 0:
-			_print(f"No audio track found tagged {config.AUDIO_LANG} for {file_path}. Using {audio_tracks[0]}", LOG_LEVEL_DEBUG)
-			return audio_tracks[0]
-		
-		_print(f"No audio track found for {file_path}", LOG_LEVEL_ERROR)
-		return 1
-
-	def _get_video_track(self, file_path):
-		ffprobe_params = [
-			config.FFPROBE_PATH,
-			'-hide_banner', '-show_streams',
-			'-print_format', 'json',
-			file_path
-		]
-		process = subprocess.Popen(
-			ffprobe_params, 
-			stdout=subprocess.PIPE,
-			stderr=subprocess.PIPE
+	def _insert_stats(self, cur, events):
+		q = (
+			"INSERT INTO playback_stats "
+			"(schedule_id, media_file_id, channel_id, encoder, "
+			"started_at, ended_at, frames, out_time, avg_fps, "
+			"avg_speed, min_speed, slow_samples, dropped_frames, "
+			"duplicated_frames, avg_bitrate) "
+			"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+		)
+		rows = []
+		for e in events:
+			s = e['stats']
+			rows.append((
+				e['id'],
+				s['media_file_id'],
+				self.channel.id,
+				s['encoder'],
+				s['started_at'],
+				e['end_time'],
+				s['frames'],
+				s['out_time'],
+				s['avg_fps'],
+				s['avg_speed'],
+				s['min_speed'],
+				s['slow_samples'],
+				s['dropped_frames'],
+				s['duplicated_frames'],
+				s['avg_bitrate']
+			))
+		cur.executemany(q, rows)
+
+	def _update_status(self, cur, column, key, completed, events):
+		update_by_id(
+			cur, 'schedule', column,
+			{e['id']: e[key] for e in events},
+			extra={'completed': completed}
 		)
 
-		#process.wait()
-		data, err = process.communicate()
-		if process.returncode == 0:
-			output = json.loads(data.decode('utf-8'))
-
-			for stream in output.get('streams', []):
-				if stream.get('codec_type') == 'video':
-					_print(f"Found video track for {file_path} ({stream['index']})", LOG_LEVEL_DEBUG)
-					return stream['index']
-		
-		_print(f"No video track found for {file_path}", LOG_LEVEL_ERROR)
-		return 0
+class Supervisor:
+	def __init__(self, channels=None, logger=None):
+		self.channels = channels if channels is not None else get_channels()
+		self._logger = logger
 
-	def _handle_completed(self, completed_queue):
-		db = get_mysql_connection()
-		cur = db.cursor()
-		while True:
-			try:
-				completed = completed_queue.get(block=False)
-				if completed.get('start_time') is not None:
-					_print(f"Setting start time to {completed['start_time']} for {completed['id']}", LOG_LEVEL_DEBUG)
-					q = (
-						"UPDATE schedule "
-						"SET actual_start_time = %s, "
-						"completed = 0 "
-						"WHERE id = %s"
-					)
-					cur.execute(q, (completed['start_time'], completed['id']))
-				
-				if completed.get('end_time') is not None:
-					_print(f"Setting end time to {completed['end_time']} for {completed['id']}", LOG_LEVEL_DEBUG)
-					q = (
-						"UPDATE schedule "
-						"SET actual_end_time = %s, "
-						"completed = 1 "
-						"WHERE id = %s"
-					)
-					cur.execute(q, (
-						completed['end_time'],
-						completed['id']
-					))
-				db.commit()
-
-			except queue.Empty:
-				cur.close()
-				db.close()
-				return
+	def run(self):
+		## One player per channel, each with its own schedule window and
+		## ffmpeg pipeline. Probe data and encoder calibration are shared
+		players = [Player(logger=self._logger, channel=c) for c in self.channels]
+		threads = []
+		for player in players:
+			t = threading.Thread(target=player.play, name=f"channel-{player.channel.number}")
+			t.start()
+			threads.append(t)
+			_print(f"Started channel {player.channel.number} ({player.channel.name})", LOG_LEVEL_INFO)
+
+		try:
+			for t in threads:
+				t.join()
+		except KeyboardInterrupt:
+			_print("Stopping all channels", LOG_LEVEL_INFO)
+			for player in players:
+				player.stop()
+			for t in threads:
+				t.join()
+
+		for player in players:
+			player.close()
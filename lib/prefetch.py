@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+
+from lib.common import Logger
+from lib.vars import *
+import config
+
+_print = Logger()._print
+
+CHUNK_SIZE = 1024*1024
+## A single chunk read slower than this means the disk had to spin up or
+## the NAS was busy
+STALL_SECONDS = 0.5
+
+class Prefetcher:
+	def __init__(self, read_ahead_mb=None, logger=None):
+		if read_ahead_mb is None:
+			read_ahead_mb = config.PREFETCH_MB
+		self.read_ahead = int(read_ahead_mb * 1024 * 1024)
+
+		self._lock = threading.Lock()
+		## path -> {'done': bool, 'bytes': int, 'seconds': float}
+		self._jobs = {}
+
+		self.hits = 0
+		self.misses = 0
+		self.stalls = 0
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def prefetch(self, path, skipto=None, duration=None):
+		if self.read_ahead <= 0 or not path:
+			return
+
+		with self._lock:
+			if path in self._jobs:
+				return
+			job = {'done': False, 'bytes': 0, 'seconds': 0.0}
+			self._jobs[path] = job
+
+		regions = [(0, self.read_ahead)]
+		if skipto and duration:
+			## Estimate where ffmpeg will seek to from the bitrate average
+			try:
+				size = os.path.getsize(path)
+				seek_offset = int(size * min(skipto / duration, 1.0))
+				regions.append((max(seek_offset - self.read_ahead // 4, 0), self.read_ahead))
+			except OSError:
+				pass
+
+		t = threading.Thread(target=self._warm, args=(path, regions, job), daemon=True)
+		t.start()
+
+	def _warm(self, path, regions, job):
+		started = time.monotonic()
+		try:
+			fd = os.open(path, os.O_RDONLY)
+		except OSError as e:
+			_print(f"Prefetch could not open {path}: {e}", LOG_LEVEL_ERROR)
+			job['done'] = True
+			return
+
+		try:
+			for offset, length in regions:
+				if hasattr(os, 'posix_fadvise'):
+					os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+				## fadvise is only a hint and network filesystems tend to
+				## ignore it, so actually read the region into the page cache
+				position = offset
+				while position < offset + length:
+					chunk_started = time.monotonic()
+					data = os.pread(fd, CHUNK_SIZE, position)
+					if not data:
+						break
+					if time.monotonic() - chunk_started > STALL_SECONDS:
+						with self._lock:
+							self.stalls += 1
+					job['bytes'] += len(data)
+					position += len(data)
+		except OSError as e:
+			_print(f"Prefetch failed for {path}: {e}", LOG_LEVEL_ERROR)
+		finally:
+			os.close(fd)
+
+		job['seconds'] = time.monotonic() - started
+		job['done'] = True
+		_print(f"Prefetched {job['bytes'] / (1024*1024):.1f}MB of {path} in {job['seconds']:.2f}s", LOG_LEVEL_DEBUG)
+
+	def claim(self, path):
+		if self.read_ahead <= 0:
+			return
+
+		with self._lock:
+			job = self._jobs.pop(path, None)
+			if job is not None and job['done']:
+				self.hits += 1
+				result = "hit"
+			else:
+				self.misses += 1
+				result = "miss (still reading)" if job is not None else "miss"
+
+		_print(f"Prefetch {result} for {path} [hits: {self.hits} misses: {self.misses} stalls: {self.stalls}]", LOG_LEVEL_INFO)
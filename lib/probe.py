@@ -0,0 +1,130 @@
+from datetime import datetime
+import os
+import subprocess
+import json
+
+from lib.common import get_mysql_connection, Logger
+from lib.queries import PROBE_CACHE_LOOKUP
+from lib.vars import *
+import config
+
+_print = Logger()._print
+
+class ProbeCache:
+	def __init__(self, db=None, logger=None):
+		self._own_db = db is None
+		self._db = db if db is not None else get_mysql_connection()
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def close(self):
+		if self._own_db:
+			self._db.close()
+
+	def get(self, path):
+		try:
+			st = os.stat(path)
+		except OSError:
+			_print(f"Cannot stat {path}", LOG_LEVEL_ERROR)
+			return None
+
+		if self._own_db:
+			self._db.ping(reconnect=True, attempts=3, delay=1)
+		cur = self._db.cursor(dictionary=True)
+
+		cur.execute(PROBE_CACHE_LOOKUP, (path, ))
+		cached = cur.fetchone()
+
+		if (cached and cached['probe_data']
+			and cached['size'] == st.st_size
+			and cached['mtime'] == st.st_mtime):
+
+			cur.close()
+			return json.loads(cached['probe_data'])
+
+		## New file or it changed on disk since the last probe
+		data = self.probe(path)
+		if data is None:
+			cur.close()
+			return None
+
+		q = (
+			"INSERT INTO media_files "
+			"(path, size, mtime, probe_data, probed_at) "
+			"VALUES (%s, %s, %s, %s, %s) "
+			"ON DUPLICATE KEY UPDATE "
+			"size = VALUES(size), "
+			"mtime = VALUES(mtime), "
+			"probe_data = VALUES(probe_data), "
+			"probed_at = VALUES(probed_at)"
+		)
+		cur.execute(q, (path, st.st_size, st.st_mtime, json.dumps(data), datetime.now()))
+		self._db.commit()
+		cur.close()
+
+		return data
+
+	def probe(self, path):
+		_print(f"Probing {path}", LOG_LEVEL_DEBUG)
+		ffprobe_params = [
+			config.FFPROBE_PATH,
+			'-v', 'error', '-hide_banner',
+			'-show_streams', '-show_format',
+			'-print_format', 'json',
+			path
+		]
+		process = subprocess.Popen(
+			ffprobe_params,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE
+		)
+		data, err = process.communicate()
+		if process.returncode != 0:
+			_print(f"ffprobe failed for {path}", LOG_LEVEL_ERROR)
+			return None
+
+		return json.loads(data.decode('utf-8'))
+
+def get_duration(probe):
+	try:
+		return int(float(probe['format']['duration']))
+	except (KeyError, TypeError, ValueError):
+		return None
+
+def get_audio_track(probe, file_path):
+	audio_tracks = []
+	preferred_lang_tracks = []
+	if probe is not None:
+		for stream in probe.get('streams', []):
+			if stream.get('codec_type') != 'audio':
+				continue
+			audio_tracks.append(stream['index'])
+			if stream.get('tags', {}).get('language', '').lower() == config.AUDIO_LANG:
+				if stream.get('codec_name') in ['dts', 'ac3', 'aac']:
+					_print(f"Found {stream['codec_name']} {config.AUDIO_LANG} audio track for {file_path} ({stream['index']})", LOG_LEVEL_DEBUG)
+					return stream['index']
+				preferred_lang_tracks.append(stream)
+
+	if len(preferred_lang_tracks) > 0:
+		_print("No ac3/aac audio track found. Using first track for preferred language:", LOG_LEVEL_DEBUG)
+		_print(f"  codec: {preferred_lang_tracks[0]['codec_name']} track: {preferred_lang_tracks[0]['index']}", LOG_LEVEL_DEBUG)
+		return preferred_lang_tracks[0]['index']
+
+	if len(audio_tracks) > 0:
+		_print(f"No audio track found tagged {config.AUDIO_LANG} for {file_path}. Using {audio_tracks[0]}", LOG_LEVEL_DEBUG)
+		return audio_tracks[0]
+
+	_print(f"No audio track found for {file_path}", LOG_LEVEL_ERROR)
+	return 1
+
+def get_video_track(probe, file_path):
+	if probe is not None:
+		for stream in probe.get('streams', []):
+			if stream.get('codec_type') == 'video':
+				_print(f"Found video track for {file_path} ({stream['index']})", LOG_LEVEL_DEBUG)
+				return stream['index']
+
+	_print(f"No video track found for {file_path}", LOG_LEVEL_ERROR)
+	return 0
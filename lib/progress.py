@@ -0,0 +1,122 @@
+import threading
+
+from lib.common import Logger
+from lib.vars import *
+
+_print = Logger()._print
+
+## Below this ffmpeg isn't keeping up with -re and the stream will stall
+SLOW_SPEED = 0.95
+## Speed readings are unreliable while ffmpeg is still starting up
+WARMUP_SECONDS = 10
+
+def _parse_float(value, suffix=''):
+	if value is None:
+		return None
+	value = value.strip()
+	if suffix and value.endswith(suffix):
+		value = value[:-len(suffix)]
+	try:
+		return float(value)
+	except ValueError:
+		## N/A before the first frame is written
+		return None
+
+class ProgressReader(threading.Thread):
+	def __init__(self, stream, label=None, logger=None):
+		threading.Thread.__init__(self, daemon=True)
+		self._stream = stream
+		self._label = label
+
+		self.samples = 0
+		self.frames = 0
+		self.out_time = 0.0
+		self.dropped_frames = 0
+		self.duplicated_frames = 0
+		self.min_speed = None
+		self.slow_samples = 0
+		self._fps_total = 0.0
+		self._fps_samples = 0
+		self._speed_total = 0.0
+		self._speed_samples = 0
+		self._bitrate_total = 0.0
+		self._bitrate_samples = 0
+		self._warned = False
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def run(self):
+		## -progress writes key=value lines and ends each block with
+		## progress=continue or progress=end. Anything else on the pipe is
+		## an error message from -v error
+		block = {}
+		for raw in iter(self._stream.readline, b''):
+			line = raw.decode('utf-8', 'replace').strip()
+			if not line:
+				continue
+			key, sep, value = line.partition('=')
+			if not sep or ' ' in key:
+				_print(f"ffmpeg: {line}", LOG_LEVEL_ERROR)
+				continue
+
+			if key == 'progress':
+				self._add_sample(block)
+				block = {}
+			else:
+				block[key] = value
+		self._stream.close()
+
+	def _add_sample(self, block):
+		self.samples += 1
+
+		frames = _parse_float(block.get('frame'))
+		if frames is not None:
+			self.frames = int(frames)
+		dropped = _parse_float(block.get('drop_frames'))
+		if dropped is not None:
+			self.dropped_frames = int(dropped)
+		duplicated = _parse_float(block.get('dup_frames'))
+		if duplicated is not None:
+			self.duplicated_frames = int(duplicated)
+		out_time_us = _parse_float(block.get('out_time_us'))
+		if out_time_us is not None:
+			self.out_time = out_time_us / 1000000
+
+		## Only count rates once ffmpeg has settled into -re pacing
+		if self.out_time < WARMUP_SECONDS:
+			return
+
+		fps = _parse_float(block.get('fps'))
+		if fps is not None:
+			self._fps_total += fps
+			self._fps_samples += 1
+		bitrate = _parse_float(block.get('bitrate'), 'kbits/s')
+		if bitrate is not None:
+			self._bitrate_total += bitrate
+			self._bitrate_samples += 1
+		speed = _parse_float(block.get('speed'), 'x')
+		if speed is not None:
+			self._speed_total += speed
+			self._speed_samples += 1
+			if self.min_speed is None or speed < self.min_speed:
+				self.min_speed = speed
+			if speed < SLOW_SPEED:
+				self.slow_samples += 1
+				if not self._warned:
+					_print(f"Encoder falling behind realtime ({speed}x) for {self._label}", LOG_LEVEL_ERROR)
+					self._warned = True
+
+	def summary(self):
+		return {
+			'frames': self.frames,
+			'out_time': self.out_time,
+			'avg_fps': self._fps_total / self._fps_samples if self._fps_samples else None,
+			'avg_speed': self._speed_total / self._speed_samples if self._speed_samples else None,
+			'min_speed': self.min_speed,
+			'slow_samples': self.slow_samples,
+			'dropped_frames': self.dropped_frames,
+			'duplicated_frames': self.duplicated_frames,
+			'avg_bitrate': self._bitrate_total / self._bitrate_samples if self._bitrate_samples else None
+		}
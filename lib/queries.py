@@ -0,0 +1,115 @@
+## Queries that run on every schedule build, player loop or cron job. They
+## live here so the code and the plan check in lib/migrations.py share the
+## exact same SQL
+
+## Every player query needs the file path, whether a mezzanine exists and
+## what the source looked like when it was made
+_PLAYER_ITEM_SELECT = (
+	"SELECT schedule.*, media_files.path, "
+	"media_files.transcoded_size, media_files.transcoded_mtime, "
+	"(SELECT MAX(tv_episodes.transcoded) FROM tv_episodes "
+		"WHERE tv_episodes.media_file_id = schedule.media_file_id) AS transcoded "
+	"FROM schedule "
+	"INNER JOIN media_files "
+	"ON schedule.media_file_id = media_files.id "
+)
+
+PLAYER_CURRENT_ITEM = _PLAYER_ITEM_SELECT + (
+	"WHERE schedule.channel_id = %s "
+	"AND schedule.start_time <= NOW() "
+	"AND schedule.end_time > NOW() "
+	"ORDER BY schedule.start_time "
+	"LIMIT 1"
+)
+
+PLAYER_FIRST_UPCOMING_ITEM = _PLAYER_ITEM_SELECT + (
+	"WHERE schedule.channel_id = %s "
+	"AND schedule.start_time >= NOW() "
+	"ORDER BY schedule.start_time "
+	"LIMIT 1"
+)
+
+## Starts from the queued item's current start time, since
+## adjust_schedule_times may have moved it since it was loaded. The item
+## itself is included so the player can pick up its new times
+PLAYER_LOOKAHEAD_WINDOW = _PLAYER_ITEM_SELECT + (
+	"WHERE schedule.channel_id = %s "
+	"AND schedule.start_time >= COALESCE("
+		"(SELECT previous.start_time FROM schedule AS previous WHERE previous.id = %s), %s"
+	") "
+	"ORDER BY schedule.start_time "
+	"LIMIT %s"
+)
+
+SCHEDULE_TAIL = (
+	"SELECT end_time FROM schedule "
+	"WHERE channel_id = %s "
+	"AND end_time >= %s "
+	"ORDER BY end_time DESC "
+	"LIMIT 1"
+)
+
+PREVIOUS_INTERMISSION = (
+	"SELECT end_time "
+	"FROM schedule "
+	"WHERE channel_id = %s "
+	"AND end_time <= %s "
+	"AND tag = 'INTERMISSION' "
+	"ORDER BY end_time DESC "
+	"LIMIT 1"
+)
+
+FUTURE_INTERMISSIONS = (
+	"SELECT * FROM schedule "
+	"WHERE start_time > %s "
+	"AND tag = 'INTERMISSION' "
+	"AND media_file_id IS NULL "
+	"ORDER BY start_time"
+)
+
+ITEM_BEFORE_INTERMISSION = (
+	"SELECT * FROM schedule "
+	"WHERE channel_id = %s "
+	"AND end_time <= %s "
+	"AND tag != 'INTERMISSION' "
+	"ORDER BY end_time DESC "
+	"LIMIT 1"
+)
+
+ITEMS_AFTER_INTERMISSION = (
+	"SELECT * FROM schedule "
+	"WHERE channel_id = %s "
+	"AND start_time >= %s "
+	"AND tag != 'INTERMISSION' "
+	"ORDER BY start_time "
+	"LIMIT %s"
+)
+
+SCHEDULED_MEDIA_FILE = (
+	"SELECT * FROM schedule "
+	"WHERE media_file_id = %s "
+	"AND end_time >= NOW()"
+)
+
+PROBE_CACHE_LOOKUP = (
+	"SELECT size, mtime, probe_data "
+	"FROM media_files "
+	"WHERE path = %s"
+)
+
+PURGE_CHUNK = (
+	"SELECT id FROM schedule "
+	"WHERE end_time < %s "
+	"ORDER BY id "
+	"LIMIT %s"
+)
+
+PURGE_ARCHIVE_CHUNK = (
+	"SELECT schedule.*, media_files.path "
+	"FROM schedule "
+	"LEFT JOIN media_files "
+	"ON schedule.media_file_id = media_files.id "
+	"WHERE schedule.end_time < %s "
+	"ORDER BY schedule.id "
+	"LIMIT %s"
+)
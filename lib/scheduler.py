@@ -1,10 +1,13 @@
-import random
 from datetime import datetime, timedelta, time as dttime
-import pytz
+import os, time, json, gzip, shutil, tempfile
 from tzlocal import get_localzone
-from xml.dom import minidom
 
-from lib.common import get_mysql_connection, Logger
+from lib.common import get_mysql_connection, get_media_file_ids, file_sha256, Logger
+from lib.library import Library
+from lib.planner import Planner
+from lib.xmltv import XMLTVWriter
+from lib.channels import get_channels
+from lib.queries import SCHEDULE_TAIL, PREVIOUS_INTERMISSION, PURGE_CHUNK, PURGE_ARCHIVE_CHUNK
 import config
 from lib.vars import *
 
@@ -13,6 +16,9 @@ _print = Logger()._print
 class Scheduler:
 	def __init__(self, logger=None):
 		self._db = get_mysql_connection()
+		self._library = None
+		self._logger = logger
+		self.channels = get_channels()
 
 		if logger is not None:
 			global _print
@@ -22,629 +28,441 @@ class Scheduler:
 		self._db.close()
 
 	def get_next_episode(self, tv_show_id):
-		cur = self._db.cursor(dictionary=True)
-		q = "SELECT last_played_episode FROM tv_shows WHERE id = %s"
-		cur.execute(q, (tv_show_id, ))
-		res = cur.fetchone()
-
-		last_played = res['last_played_episode']
-		if last_played is None:
-			q = (
-				"SELECT * FROM tv_episodes "
-				"WHERE tv_show_id = %s "
-				"ORDER BY season_number, episode_number "
-				"LIMIT 1"
-			)
-			cur.execute(q, (tv_show_id, ))
-			next_episode = cur.fetchone()
-			cur.close()
-			return next_episode
-		
-		q = (
-			"SELECT season_number, episode_number "
-			"FROM tv_episodes "
-			"WHERE id = %s"
-		)
-		cur.execute(q, (last_played, ))
-		res = cur.fetchone()
-
-		## This is a bit of a hack. When episodes are changed on disk
-		## orphaned records are possibly created. For now just reset to first
-		## season and episode
-		if not res:
-			q = (
-                "SELECT * FROM tv_episodes "
-                "WHERE tv_show_id = %s "
-                "ORDER BY season_number, episode_number "
-                "LIMIT 1"
-            )
-			cur.execute(q, (tv_show_id, ))
-			next_episode = cur.fetchone()
-			cur.close()
-			return next_episode
-		## END HAX
-		last_season = res['season_number']
-		last_episode = res['episode_number']
-
-		q = (
-			"SELECT * FROM tv_episodes "
-			"WHERE tv_show_id = %s "
-			"AND season_number = %s "
-			"AND episode_number > %s "
-			"ORDER BY episode_number "
-			"LIMIT 1"
-		)
-		cur.execute(q, (tv_show_id, last_season, last_episode))
-		res = cur.fetchone()
-		if res:
-			cur.close()
-			return res
-		
-		q = (
-			"SELECT * FROM tv_episodes "
-			"WHERE tv_show_id = %s "
-			"AND season_number > %s "
-			"ORDER BY season_number, episode_number "
-			"LIMIT 1"
-		)
-		cur.execute(q, (tv_show_id, last_season))
-		res = cur.fetchone()
-		if res:
-			cur.close()
-			return res
-		
-		q = (
-			"SELECT * FROM tv_episodes "
-			"WHERE tv_show_id = %s "
-			"ORDER BY season_number, episode_number "
-			"LIMIT 1"
-		)
-		cur.execute(q, (tv_show_id, ))
-		res = cur.fetchone()
-		cur.close()
-		return res
+		if self._library is None:
+			self.load_library()
+		return self._library.episodes.peek(tv_show_id)
+
+	def load_library(self):
+		self._library = Library(logger=self._logger)
+		self._library.load(self._db)
+
+	def build_schedule(self, date=None, dry_run=False, channel=None):
+		if date is None:
+			date = datetime.now().date() + timedelta(days=1)
+		channels = [channel] if channel is not None else self.channels
+
+		## Channels plan from one library snapshot so they share episode
+		## cursors and never air the same episode twice
+		self.load_library()
+
+		plans = {}
+		for channel in channels:
+			start_time = datetime.combine(date, dttime(0))
+
+			schedule_end, last_intermission = self._get_schedule_tail(start_time, channel.id)
+			if schedule_end is not None and not dry_run:
+				if schedule_end.date() > date:
+					_print(f"Scheduled items already exist for {date} on channel {channel.number}", LOG_LEVEL_ERROR)
+					continue
+				else:
+					start_time = schedule_end
 
-	def build_schedule(self, date=datetime.now().date()+timedelta(days=1), dry_run=False):
-		start_time = datetime.combine(date, dttime(0))
-		cur = self._db.cursor(dictionary=True)
+			planner = Planner(self._library, logger=self._logger)
+			plan = planner.plan_day(date, start_time, last_intermission)
 
-		q = (
-			"SELECT * FROM schedule "
-			"WHERE end_time >= %s "
-			"ORDER BY end_time DESC "
-			"LIMIT 1"
-		)
-		cur.execute(q, (start_time, ))
-		schedule_end = cur.fetchone()
-
-		if schedule_end and not dry_run:
-			if schedule_end['end_time'].date() > date:
-				_print(f"Scheduled items already exist for {date}", LOG_LEVEL_ERROR)
-				cur.close()
-				return
-			else:
-				start_time = schedule_end['end_time']
-
-		marathon_show = None
-		marathon_data = {}
-		if random.random() <= config.MARATHON_CHANCE:
-			## All shows that have >= 20h of content
-			s = (
-				"SELECT SUM(duration) AS total_duration, tv_show_id "
-				"FROM tv_episodes "
-				"LEFT JOIN tv_shows "
-				"ON tv_episodes.tv_show_id = tv_shows.id "
-				"WHERE tv_shows.enabled = 1 "
-				"GROUP BY tv_show_id "
-				"HAVING total_duration >= 72000 "
-				"ORDER BY RAND() "
-				"LIMIT 1"
-			)
-			cur.execute(s)
-			res = cur.fetchone()
-			if res:
-				s = "SELECT * FROM tv_shows WHERE id = %s"
-				cur.execute(s, (res['tv_show_id'], ))
-				marathon_show = cur.fetchone()
-
-		if marathon_show is not None:
-			## Make sure we have at least 8 hours of open schedule this day
-			schedule_end_time = datetime.combine(date + timedelta(days=1), dttime(0))
-			time_left_in_day = (schedule_end_time - start_time).total_seconds()
-			## Not enough time for a marathon
-			if time_left_in_day < 28800:
-				marathon_show = None
+			if dry_run:
+				_print(f"Dry run: planned {len(plan)} item(s) for {date} on channel {channel.number}, nothing saved", LOG_LEVEL_INFO)
 			else:
-				## Max duration is 12 hours unless that much time isn't left in the day
-				max_duration = min(time_left_in_day, 43200)
-				## Duration is 8-12 hours
-				marathon_duration = random.randint(28800, max_duration)
-				## Start the marathon with enough time left in the day
-				marathon_start = random.randint(0, time_left_in_day - marathon_duration)
-				
-				marathon_data = {
-					'start': marathon_start,
-					'duration': marathon_duration
-				}
-
-		movies = []
-		if random.random() <= config.MOVIE_CHANCE:
-			q = (
-				"SELECT * FROM movies "
-				"WHERE enabled = 1 "
-				"ORDER BY RAND() "
-				"LIMIT 1"
-			)
-			cur.execute(q)
-			movie = cur.fetchone()
-
-			schedule_end_time = datetime.combine(date + timedelta(days=1), dttime(0))
-			time_left_in_day = (schedule_end_time - start_time).total_seconds()
-			movie_start = None
-			if marathon_show is not None:
-				time_before = marathon_data['start']
-				time_after = time_left_in_day - time_before - marathon_data['duration']
-
-				if time_before > movie['duration'] and time_after > movie['duration']:
-					if random.random() >= 0.5:
-						movie_start = random.randint(0, time_before - movie['duration'])
-					else:
-						movie_start = random.randint(marathon_data['start'] + marathon_data['duration'], time_left_in_day - movie['duration'])
-					
-				elif time_before > movie['duration']:
-					movie_start = random.randint(0, time_before - movie['duration'])
-				elif time_after > movie['duration']:
-					movie_start = random.randint(marathon_data['start'] + marathon_data['duration'], time_left_in_day - movie['duration'])
-				else:
-					_print("No time in day for movie (marathon day)", LOG_LEVEL_INFO)
-				
+				self.save_plan(plan, channel.id)
+				_print(f"Scheduled {len(plan)} item(s) for {date} on channel {channel.number}", LOG_LEVEL_INFO)
+			plans[channel.id] = plan
+
+		return plans
+
+	def build_schedule_horizon(self, days, dry_run=False, channel=None):
+		now = datetime.now().replace(second=0, microsecond=0)
+		horizon_end = now.date() + timedelta(days=days)
+		channels = [channel] if channel is not None else self.channels
+
+		## channel id -> [start_time, last_intermission]
+		tails = {}
+		for channel in channels:
+			schedule_end, last_intermission = self._get_schedule_tail(now, channel.id)
+			if schedule_end is not None and schedule_end > now:
+				tails[channel.id] = [schedule_end, last_intermission]
 			else:
-				if time_left_in_day > movie['duration']:
-					movie_start = random.randint(0, time_left_in_day - movie['duration'])
-				else:
-					_print("No time in day for movie", LOG_LEVEL_INFO)
-			
-			if movie_start:
-				movies.append({
-					'movie': movie,
-					'start_time': movie_start,
-					'scheduled': False
-				})
+				tails[channel.id] = [now, last_intermission]
 
-		q = (
-			"SELECT end_time "
-			"FROM schedule "
-			"WHERE end_time <= %s "
-			"AND tag = 'INTERMISSION' "
-			"ORDER BY end_time DESC "
-			"LIMIT 1"
-		)
-		cur.execute(q, (start_time, ))
-		prev_intermission = cur.fetchone()
-		if prev_intermission:
-			last_intermission = prev_intermission['end_time']
-		else:
-			last_intermission = start_time - timedelta(days=1)
-
-		total_duration = 0
-		previous_show = None
-		current_show_counter = 0
-		current_show_repeats = 0
-		current_show_id = None
-		in_marathon = False
-		marathon_timer = 0
-		#intermission_counter = 0
+		## One snapshot for the whole horizon so episode cursors carry over
+		## from one day to the next
+		self.load_library()
+		planner = Planner(self._library, logger=self._logger)
+
+		## Interleave channels a day at a time so their shares of each
+		## show's episodes stay in step
+		plans = {channel.id: [] for channel in channels}
 		while True:
-			if config.INTERMISSION_INTERVAL_MINUTES > 0:
-				#min_since_intermission = (total_duration - last_intermission)/60.0
-				min_since_intermission = ((start_time + timedelta(seconds=total_duration)) - last_intermission).total_seconds() / 60.0
-				if min_since_intermission > config.INTERMISSION_INTERVAL_MINUTES:
-				#if intermission_counter >= config.INTERMISSION_INTERVAL:
-					intermission_start_time = start_time + timedelta(seconds=total_duration)
-					intermission_end_time = start_time + timedelta(seconds=(total_duration + 180))
-					q = (
-						"INSERT INTO schedule "
-						"(start_time, end_time, title, path, tag) "
-						"VALUES (%s, %s, 'Intermission', NULL, 'INTERMISSION')"
-					)
-					cur.execute(q, (
-						intermission_start_time,
-						intermission_end_time
-					))
-					#intermission_counter = 0
-					total_duration += 180
-					last_intermission = start_time + timedelta(seconds=(total_duration + 180))
-					_print(f"[INTERMISSION] {intermission_start_time}-{intermission_end_time}", LOG_LEVEL_DEBUG)
-
-			if current_show_id is None or current_show_counter >= current_show_repeats and not in_marathon:
-				current_show_counter = 0
-				current_show_repeats = 0
-				meta = {
-					'show_name': None,
-					'title': 'Unknown',
-					'description': 'No Description',
-					'thumbnail': None,
-					'thumbnail_height': 0,
-					'thumbnail_width': 0
-				}
-				if previous_show is None:
-					if marathon_show is None:
-						q = (
-							"SELECT id, title, thumbnail, thumbnail_width, thumbnail_height "
-							"FROM tv_shows "
-							"WHERE enabled = 1 "
-							"ORDER BY RAND() "
-							"LIMIT 1"
-						)
-						cur.execute(q)
-					else:
-						q = (
-							"SELECT id, title, thumbnail, thumbnail_width, thumbnail_height "
-							"FROM tv_shows "
-							"WHERE enabled = 1 "
-							"AND id != %s "
-							"ORDER BY RAND() "
-							"LIMIT 1"
-						)
-						cur.execute(q, (marathon_show['id'], ))
-				else:
-					if marathon_show is None:
-						q = (
-							"SELECT id, title, thumbnail, thumbnail_width, thumbnail_height "
-							"FROM tv_shows "
-							"WHERE enabled = 1 "
-							"AND id != %s "
-							"ORDER BY RAND() "
-							"LIMIT 1"
-						)
-						cur.execute(q, (previous_show, ))
-					else:
-						q = (
-							"SELECT id, title, thumbnail, thumbnail_width, thumbnail_height "
-							"FROM tv_shows "
-							"WHERE enabled = 1 "
-							"AND id != %s "
-							"AND id != %s "
-							"ORDER BY RAND() "
-							"LIMIT 1"
-						)
-						cur.execute(q, (previous_show, marathon_show['id']))
-				res = cur.fetchone()
-				current_show_id = res['id']
-				meta['show_name'] = res['title']
-				meta['thumbnail'] = res['thumbnail']
-				meta['thumbnail_height'] = res['thumbnail_height']
-				meta['thumbnail_width'] = res['thumbnail_width']
-			elif in_marathon:
-				current_show_id = marathon_show['id']
-				meta['show_name'] = marathon_show['title']
-				meta['thumbnail'] = marathon_show['thumbnail']
-				meta['thumbnail_height'] = marathon_show['thumbnail_height']
-				meta['thumbnail_width'] = marathon_show['thumbnail_width']
-
-			next_episode = self.get_next_episode(current_show_id)
-			if not next_episode:
-				current_show_counter = 0
-				current_show_repeats = 0
-				continue
-
-			## See if we entered MARATHON TIME
-			if (marathon_show is not None 
-				and total_duration + next_episode['duration'] > marathon_data['start'] 
-				and not in_marathon 
-				and marathon_timer == 0):
-
-				in_marathon = True
-				current_show_counter = 0
-				current_show_repeats = 0
-				continue
-
-			## See if we should be playing a movie
-			movie_added = False
-			for movie in movies:
-				if movie['scheduled']:
+			active = [c for c in channels if tails[c.id][0].date() <= horizon_end]
+			if not active:
+				break
+
+			for channel in active:
+				start_time, last_intermission = tails[channel.id]
+				date = start_time.date()
+				plan = planner.plan_day(date, start_time, last_intermission)
+				if not plan:
+					_print(f"Nothing could be planned for {date} on channel {channel.number}", LOG_LEVEL_ERROR)
+					channels = [c for c in channels if c.id != channel.id]
 					continue
-				if total_duration + next_episode['duration'] > movie['start_time']:
-					movie_start_time = start_time + timedelta(seconds=total_duration)
-					movie_end_time = start_time + timedelta(seconds=(total_duration + movie['movie']['duration']))
-					q = (
-						"INSERT INTO schedule "
-						"(start_time, end_time, "
-						"title, description, path, thumbnail, "
-						"thumbnail_height, thumbnail_width, tag) "
-						"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'MOVIE')"
-					)
-					cur.execute(q, (
-						movie_start_time,
-						movie_end_time,
-						movie['movie']['title'],
-						movie['movie']['description'],
-						movie['movie']['path'],
-						movie['movie']['thumbnail'],
-						movie['movie']['thumbnail_width'],
-						movie['movie']['thumbnail_height']
-					))
-
-					q = (
-						"UPDATE movies "
-						"SET last_played = %s "
-						"WHERE id = %s"
-					)
-					cur.execute(q, (movie_start_time, movie['movie']['id']))
-
-					total_duration += movie['movie']['duration']
-					movie['scheduled'] = True
-					movie_added = True
-					_print(f"[MOVIE] {movie_start_time}-{movie_end_time} {movie['movie']['title']}", LOG_LEVEL_DEBUG)
-					if not dry_run:
-						self._db.commit()
-					break
-			if movie_added:
-				#intermission_counter += 1
-				continue
-				
-
-			## If we are in a marathon and this one exceeds the timer, go back to normal
-			if in_marathon and marathon_timer + next_episode['duration'] > marathon_data['duration']:
-				in_marathon = False
-				continue
-
-			meta['description'] = next_episode['description']
-			
-			if current_show_counter >= current_show_repeats:
-				current_show_counter = 0
-				## Allow more repeats of shorter shows
-				if next_episode['duration'] > 1800:
-					possible_repeats = [2]
-				else:
-					possible_repeats = [2,4]
-				
-				if random.random() < 0.4:
-					current_show_repeats = possible_repeats[random.randint(0, len(possible_repeats)-1)]
+
+				if dry_run:
+					_print(f"Dry run: planned {len(plan)} item(s) for {date} on channel {channel.number}, nothing saved", LOG_LEVEL_INFO)
 				else:
-					current_show_repeats = 0
-			
-			episode_start_time = start_time + timedelta(seconds=total_duration)
-			episode_end_time = start_time + timedelta(seconds=(total_duration + next_episode['duration']))
-
-			previous_show = next_episode['tv_show_id']
-			current_show_counter += 1
-			total_duration += next_episode['duration']
-
-			if in_marathon:
-				marathon_timer += next_episode['duration']
-				meta['title'] = f"{meta['show_name']} Marathon! S{next_episode['season_number']} E{next_episode['episode_number']}"
-			else:
-				meta['title'] = f"{meta['show_name']} S{next_episode['season_number']} E{next_episode['episode_number']}"
+					self.save_plan(plan, channel.id)
+					_print(f"Scheduled {len(plan)} item(s) for {date} on channel {channel.number}", LOG_LEVEL_INFO)
+
+				for entry in reversed(plan):
+					if entry.tag == 'INTERMISSION':
+						last_intermission = entry.end_time
+						break
+				tails[channel.id] = [plan[-1].end_time, last_intermission]
+				plans[channel.id].append(plan)
+
+		if not any(plans.values()):
+			_print(f"Schedule already filled through {horizon_end}", LOG_LEVEL_INFO)
+		return plans
+
+	def _get_schedule_tail(self, start_time, channel_id):
+		cur = self._db.cursor(dictionary=True)
+
+		cur.execute(SCHEDULE_TAIL, (channel_id, start_time))
+		res = cur.fetchone()
+		schedule_end = res['end_time'] if res else None
+
+		cur.execute(PREVIOUS_INTERMISSION, (channel_id, schedule_end or start_time))
+		res = cur.fetchone()
+		last_intermission = res['end_time'] if res else None
+
+		cur.close()
+		return schedule_end, last_intermission
+
+	def save_plan(self, plan, channel_id):
+		cur = self._db.cursor()
+
+		movies_played = {}
+		for entry in plan:
+			if entry.movie_id is not None:
+				movies_played[entry.movie_id] = entry.start_time
+
+		## Write the whole plan in one transaction so a failure can't leave
+		## a partial schedule behind
+		try:
+			## Movies are only known by path so they get their media file
+			## ids here
+			media_file_ids = get_media_file_ids(self._db, [
+				entry.path for entry in plan
+				if entry.media_file_id is None and entry.path
+			])
+			for entry in plan:
+				if entry.media_file_id is None and entry.path:
+					entry.media_file_id = media_file_ids[entry.path]
 
 			q = (
 				"INSERT INTO schedule "
-				"(start_time, end_time, is_marathon, "
-				"title, description, path, thumbnail, "
+				"(channel_id, start_time, end_time, is_marathon, "
+				"title, description, media_file_id, thumbnail, "
 				"thumbnail_height, thumbnail_width, tag) "
-				"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+				"VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
 			)
-			cur.execute(q, (
-				episode_start_time, 
-				episode_end_time, 
-				in_marathon*1,
-				meta['title'],
-				meta['description'],
-				next_episode['path'],
-				meta['thumbnail'],
-				meta['thumbnail_height'],
-				meta['thumbnail_width'],
-				'TV_MARATHON' if in_marathon else 'TV_EPISODE'
-			))
-
-			q = "UPDATE tv_shows SET last_played_episode = %s WHERE id = %s"
-			cur.execute(q, (next_episode['id'], next_episode['tv_show_id']))
-			#intermission_counter += 1
-
-			if not in_marathon:
-				_print(f"[TV SHOW] {episode_start_time}-{episode_end_time} {meta['title']}", LOG_LEVEL_DEBUG)
-			else:
-				_print(f"[MARATHON] {episode_start_time}-{episode_end_time} {meta['title']}", LOG_LEVEL_DEBUG)
+			cur.executemany(q, [(channel_id, ) + entry.as_row() for entry in plan])
 
-			if not dry_run:
-				self._db.commit()
+			if movies_played:
+				q = "UPDATE movies SET last_played = %s WHERE id = %s"
+				cur.executemany(q, [(v, k) for k, v in movies_played.items()])
 
-			if episode_end_time.date() > date:
-				break
+			if self._library is not None:
+				self._library.episodes.save(cur)
+
+			self._db.commit()
+		except:
+			self._db.rollback()
+			cur.close()
+			raise
 
 		cur.close()
 
-	def generate_xmltv(self, output_file):
-		cur = self._db.cursor(dictionary=True)
+	def generate_xmltv(self, output_file, compress=None):
+		if compress is None:
+			compress = config.XMLTV_GZIP
+
+		## Unbuffered cursor so rows are streamed from the server rather
+		## than loaded all at once
+		cur = self._db.cursor(dictionary=True, buffered=False)
 		schedule_start = datetime.combine((datetime.now() - timedelta(days=1)).date(), dttime(0))
-		
-		q = "SELECT * FROM schedule WHERE start_time >= %s"
+
+		q = (
+			"SELECT channel_id, start_time, end_time, title, description, "
+			"thumbnail, thumbnail_width, thumbnail_height "
+			"FROM schedule "
+			"WHERE start_time >= %s "
+			"ORDER BY start_time"
+		)
 		cur.execute(q, (schedule_start, ))
-		schedule = cur.fetchall()
-
-		root = minidom.Document()
-		tv_element = root.createElement('tv')
-		root.appendChild(tv_element)
-
-		channel_element = root.createElement('channel')
-		channel_element.setAttribute("id", config.CHANNEL_NUMBER)
-		display_name_element = root.createElement('display-name')
-		display_name_element.appendChild(root.createTextNode(config.CHANNEL_NAME))
-		channel_element.appendChild(display_name_element)
-		if config.CHANNEL_ICON:
-			icon_element = root.createElement('icon')
-			icon_element.setAttribute("src", config.CHANNEL_ICON)
-			icon_element.setAttribute("width", "100")
-			icon_element.setAttribute("height", "100")
-			channel_element.appendChild(icon_element)
-
-		tv_element.appendChild(channel_element)
-
-		for s in schedule:
-			tz = pytz.timezone(config.TIMEZONE)
-			start_aware = tz.localize(s['start_time'] + timedelta(seconds=30))
-			end_aware = tz.localize(s['end_time'] + timedelta(seconds=30))
-
-			program_element = root.createElement('programme')
-			program_element.setAttribute("start", start_aware.strftime("%Y%m%d%H%M%S %z"))
-			program_element.setAttribute("stop", end_aware.strftime("%Y%m%d%H%M%S %z"))
-			program_element.setAttribute("channel", config.CHANNEL_NUMBER)
-
-			title_element = root.createElement("title")
-			title_element.setAttribute("lang", "en")
-			title_element.appendChild(root.createTextNode(s['title']))
-
-			description = s['description']
-			if description is None:
-				description = "No description"
-			desc_element = root.createElement("desc")
-			desc_element.setAttribute("lang", "en")
-			desc_element.appendChild(root.createTextNode(description))
-			
-
-			program_element.appendChild(title_element)
-			program_element.appendChild(desc_element)
-
-			if s['thumbnail'] and s['thumbnail_width'] and s['thumbnail_height']:
-				icon_element = root.createElement('icon')
-				icon_element.setAttribute('src', s['thumbnail'])
-				icon_element.setAttribute('width', str(s['thumbnail_width']))
-				icon_element.setAttribute('height', str(s['thumbnail_height']))
-				program_element.appendChild(icon_element)
-
-			tv_element.appendChild(program_element)
-
-
-		xml_str = root.toprettyxml(indent = "  ")
-		with open(output_file, 'w') as f:
-			f.write(xml_str)
 
-		cur.close()
+		## Write to a temp file next to the output so the final rename is
+		## atomic and clients never see a half written guide
+		output_dir = os.path.dirname(os.path.abspath(output_file))
+		fd, tmp_file = tempfile.mkstemp(dir=output_dir, prefix='.xmltv-', suffix='.tmp')
+		try:
+			programmes = 0
+			with os.fdopen(fd, 'w', encoding='utf-8') as f:
+				writer = XMLTVWriter(f, config.TIMEZONE)
+				writer.start()
+				numbers = {}
+				for channel in self.channels:
+					writer.write_channel(channel.number, channel.name, channel.icon)
+					numbers[channel.id] = channel.number
+				for s in cur:
+					if s['channel_id'] not in numbers:
+						continue
+					writer.write_programme(s, numbers[s['channel_id']])
+					programmes += 1
+				writer.end()
+			cur.close()
+
+			gz_file = f"{output_file}.gz"
+			if (os.path.exists(output_file)
+				and file_sha256(output_file) == file_sha256(tmp_file)
+				and (not compress or os.path.exists(gz_file))):
+
+				_print(f"XMLTV unchanged, not rewriting {output_file}", LOG_LEVEL_INFO)
+				os.remove(tmp_file)
+				return False
+
+			os.chmod(tmp_file, 0o644)
+			if compress:
+				fd, tmp_gz_file = tempfile.mkstemp(dir=output_dir, prefix='.xmltv-', suffix='.gz.tmp')
+				with open(tmp_file, 'rb') as f_in, os.fdopen(fd, 'wb') as f_out:
+					with gzip.GzipFile(fileobj=f_out, mode='wb', mtime=0) as gz:
+						shutil.copyfileobj(f_in, gz)
+				os.chmod(tmp_gz_file, 0o644)
+				os.replace(tmp_gz_file, gz_file)
+
+			os.replace(tmp_file, output_file)
+		except:
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+			raise
+
+		_print(f"Wrote {programmes} programme(s) to {output_file}", LOG_LEVEL_DEBUG)
+		return True
+
+	def purge_old(self, history_days=14, dry_run=False, chunk_size=1000, archive_path=None):
+		if archive_path is None:
+			archive_path = config.SCHEDULE_ARCHIVE_PATH
 
-	def purge_old(self, history_days=14, dry_run=False):
 		cur = self._db.cursor(dictionary=True)
 
 		purge_prior = datetime.now() - timedelta(days=history_days)
 		_print(f"Purging schedule prior to {purge_prior}", LOG_LEVEL_INFO)
 
 		q = (
-			"SELECT * FROM schedule "
+			"SELECT COUNT(*) AS total FROM schedule "
 			"WHERE end_time < %s"
 		)
 		cur.execute(q, (purge_prior, ))
-		res = cur.fetchall()
-		
-		_print(f"{len(res)} records to purge...", LOG_LEVEL_INFO)
+		total = cur.fetchone()['total']
+
+		_print(f"{total} records to purge...", LOG_LEVEL_INFO)
 
 		if dry_run:
 			_print("No records purged", LOG_LEVEL_INFO)
+			cur.close()
+			return 0
+
+		## Delete in small batches by primary key so the player isn't
+		## blocked behind one long table lock
+		if archive_path:
+			q = PURGE_ARCHIVE_CHUNK
 		else:
-			q = (
-				"DELETE FROM schedule "
-				"WHERE end_time < %s"
-			)
-			cur.execute(q, (purge_prior, ))
-			_print("Purged!", LOG_LEVEL_INFO)
-		
-		self._db.commit()
+			q = PURGE_CHUNK
+
+		purged = 0
+		while True:
+			cur.execute(q, (purge_prior, chunk_size))
+			rows = cur.fetchall()
+			if not rows:
+				break
+
+			if archive_path:
+				self._archive_schedule_rows(rows, archive_path)
+
+			ids = [r['id'] for r in rows]
+			placeholders = ", ".join(["%s"] * len(ids))
+			cur.execute(f"DELETE FROM schedule WHERE id IN ({placeholders})", ids)
+			self._db.commit()
+
+			purged += cur.rowcount
+			_print(f"Purged {purged}/{total}", LOG_LEVEL_DEBUG)
+
+		_print(f"Purged {purged} records!", LOG_LEVEL_INFO)
 		cur.close()
-	
-	def fix(self):
+		return purged
+
+	def _archive_schedule_rows(self, rows, archive_path):
+		os.makedirs(archive_path, exist_ok=True)
+
+		by_month = {}
+		for r in rows:
+			by_month.setdefault(r['start_time'].strftime("%Y-%m"), []).append(r)
+
+		## Appending to a gzip file adds a new member which zcat and
+		## gzip.open read back as one stream
+		for month, month_rows in by_month.items():
+			archive_file = os.path.join(archive_path, f"schedule-{month}.jsonl.gz")
+			with gzip.open(archive_file, 'at', encoding='utf-8') as f:
+				for r in month_rows:
+					f.write(json.dumps(r, default=str) + "\n")
+
+	def fix(self, chunk_size=5000):
 		cur = self._db.cursor(dictionary=True)
-		q = "SELECT * FROM schedule"
-		cur.execute(q)
-		schedule = cur.fetchall()
 
-		for s in schedule:
-			q = (
-				"SELECT tv_episodes.path, tv_episodes.description AS episode_desc, "
-				"tv_shows.thumbnail, tv_shows.thumbnail_height, "
-				"tv_shows.thumbnail_width, tv_shows.title, "
-				"tv_shows.description AS show_desc, tv_episodes.season_number, "
-				"tv_episodes.episode_number "
-				"FROM tv_episodes "
-				"LEFT JOIN tv_shows "
-				"ON tv_episodes.tv_show_id = tv_shows.id where tv_episodes.id = %s "
-				"LIMIT 1"
-			)
-			cur.execute(q, (s['tv_episode_id'],))
-			data = cur.fetchone()
+		q = "SELECT MIN(id) AS min_id, MAX(id) AS max_id FROM schedule"
+		cur.execute(q)
+		res = cur.fetchone()
+		if res['min_id'] is None:
+			_print("Schedule is empty", LOG_LEVEL_INFO)
+			cur.close()
+			return 0
+
+		## Titles, descriptions and thumbnails are copied from the library
+		## with set based updates over id ranges rather than row by row
+		episode_q = (
+			"UPDATE schedule "
+			"INNER JOIN tv_episodes "
+			"ON schedule.media_file_id = tv_episodes.media_file_id "
+			"INNER JOIN tv_shows "
+			"ON tv_episodes.tv_show_id = tv_shows.id "
+			"SET schedule.title = CONCAT("
+				"tv_shows.title, "
+				"IF(schedule.is_marathon, ' Marathon!', ''), "
+				"' S', tv_episodes.season_number, "
+				"' E', tv_episodes.episode_number"
+			"), "
+			"schedule.description = tv_episodes.description, "
+			"schedule.thumbnail = tv_shows.thumbnail, "
+			"schedule.thumbnail_height = tv_shows.thumbnail_height, "
+			"schedule.thumbnail_width = tv_shows.thumbnail_width "
+			"WHERE schedule.id BETWEEN %s AND %s "
+			"AND schedule.tag IN ('TV_EPISODE', 'TV_MARATHON')"
+		)
+		movie_q = (
+			"UPDATE schedule "
+			"INNER JOIN media_files "
+			"ON schedule.media_file_id = media_files.id "
+			"INNER JOIN movies "
+			"ON movies.path = media_files.path "
+			"SET schedule.title = movies.title, "
+			"schedule.description = movies.description, "
+			"schedule.thumbnail = movies.thumbnail, "
+			"schedule.thumbnail_height = movies.thumbnail_height, "
+			"schedule.thumbnail_width = movies.thumbnail_width "
+			"WHERE schedule.id BETWEEN %s AND %s "
+			"AND schedule.tag = 'MOVIE'"
+		)
 
-			title = f"{data['title']} S{data['season_number']} E{data['episode_number']}"
-			
-			q = (
-				"UPDATE schedule "
-				"SET title = %s, "
-				"description = %s, "
-				"path = %s, "
-				"thumbnail = %s, "
-				"thumbnail_height = %s, "
-				"thumbnail_width = %s "
-				"WHERE id = %s"
-			)
-			cur.execute(q, (
-				title, 
-				data['episode_desc'], 
-				data['path'], 
-				data['thumbnail'],
-				data['thumbnail_height'],
-				data['thumbnail_width'],
-				s['id']
-			))
-
-		self._db.commit()
+		started = time.time()
+		changed = 0
+		total_ids = res['max_id'] - res['min_id'] + 1
+		for chunk_start in range(res['min_id'], res['max_id'] + 1, chunk_size):
+			chunk_end = chunk_start + chunk_size - 1
+			cur.execute(episode_q, (chunk_start, chunk_end))
+			changed += cur.rowcount
+			cur.execute(movie_q, (chunk_start, chunk_end))
+			changed += cur.rowcount
+			self._db.commit()
+
+			done = min(chunk_end, res['max_id']) - res['min_id'] + 1
+			_print(f"Refreshed ids up to {min(chunk_end, res['max_id'])} ({done * 100 // total_ids}%), {changed} row(s) changed", LOG_LEVEL_INFO)
+
+		_print(f"Refreshed schedule metadata in {time.time() - started:.2f}s", LOG_LEVEL_INFO)
 		cur.close()
+		return changed
 
-	def adjust_schedule_times(self):
+	def adjust_schedule_times(self, channel=None):
+		channels = [channel] if channel is not None else self.channels
+
+		## Each channel drifts on its own, so each gets its own offset
+		moved = 0
+		for channel in channels:
+			moved += self._adjust_channel_times(channel)
+		return moved
+
+	def _adjust_channel_times(self, channel):
 		cur = self._db.cursor(dictionary=True)
 
 		q = (
 			"SELECT * "
 			"FROM schedule "
-			"WHERE completed = 1 "
+			"WHERE channel_id = %s "
+			"AND completed = 1 "
 			"AND actual_end_time IS NOT NULL "
 			"ORDER BY start_time DESC "
 			"LIMIT 1"
 		)
-		cur.execute(q)
+		cur.execute(q, (channel.id, ))
 		recent_finish = cur.fetchone()
 
 		if not recent_finish:
-			_print("Nothing has ever played?", LOG_LEVEL_ERROR)
+			_print(f"Nothing has ever played on channel {channel.number}?", LOG_LEVEL_ERROR)
 			cur.close()
-			return
+			return 0
 		
 		if recent_finish['end_time'] == recent_finish['actual_end_time']:
-			_print("Times already match", LOG_LEVEL_INFO)
+			_print(f"Times already match on channel {channel.number}", LOG_LEVEL_INFO)
 			cur.close()
-			return
+			return 0
 		
 		offset = (recent_finish['actual_end_time'] - recent_finish['end_time']).total_seconds()
 		_print(f"Offset is {offset}s", LOG_LEVEL_INFO)
 
+		started = time.time()
+		now = datetime.now()
+
+		## Find the first gap in the contiguous run of future items. Everything
+		## before it gets shifted, everything after is left alone
 		q = (
-			"SELECT * "
-			"FROM schedule "
-			"WHERE start_time > NOW() "
-			"AND actual_start_time IS NULL "
-			"AND completed = 0 "
-			"ORDER BY start_time"
+			"SELECT MIN(start_time) AS gap_start "
+			"FROM ("
+				"SELECT start_time, "
+				"LAG(end_time) OVER (ORDER BY start_time) AS previous_end "
+				"FROM schedule "
+				"WHERE channel_id = %s "
+				"AND start_time > %s "
+				"AND actual_start_time IS NULL "
+				"AND completed = 0"
+			") future_items "
+			"WHERE previous_end < start_time"
 		)
-		cur.execute(q)
-		future_items = cur.fetchall()
+		cur.execute(q, (channel.id, now))
+		gap_start = cur.fetchone()['gap_start']
+
+		try:
+			q = (
+				"UPDATE schedule "
+				"SET start_time = start_time + INTERVAL %s MICROSECOND, "
+				"end_time = end_time + INTERVAL %s MICROSECOND "
+				"WHERE channel_id = %s "
+				"AND start_time > %s "
+				"AND actual_start_time IS NULL "
+				"AND completed = 0"
+			)
+			params = [int(offset * 1000000), int(offset * 1000000), channel.id, now]
+			if gap_start is not None:
+				q += " AND start_time < %s"
+				params.append(gap_start)
+			cur.execute(q, params)
+			moved = cur.rowcount
+
+			self._db.commit()
+		except:
+			self._db.rollback()
+			cur.close()
+			raise
+
+		if gap_start is not None:
+			_print(f"Gap in schedule found at {gap_start}. No further adjustments made", LOG_LEVEL_INFO)
+		_print(f"Moved {moved} item(s) on channel {channel.number} by {offset}s in {time.time() - started:.2f}s", LOG_LEVEL_INFO)
 
-		previous = None
-		for schedule in future_items:
-			if previous and previous['end_time'] < schedule['start_time']:
-				_print(f"Gap in schedule found at {schedule['start_time']}. No further adjustments made", LOG_LEVEL_INFO)
-				break
-			q = "UPDATE schedule SET start_time = %s, end_time = %s WHERE id = %s"
-			cur.execute(q, (
-				schedule['start_time'] + timedelta(seconds=offset),
-				schedule['end_time'] + timedelta(seconds=offset),
-				schedule['id']
-			))
-			previous = schedule
-
-		self._db.commit()
 		cur.close()
+		return moved
@@ -0,0 +1,223 @@
+from datetime import datetime, timedelta
+import os
+import subprocess
+
+from lib.common import get_mysql_connection, Logger
+from lib.probe import ProbeCache, get_audio_track, get_video_track
+from lib.encoders import get_backend
+from lib.vars import *
+import config
+
+_print = Logger()._print
+
+def mezzanine_path(media_file_id):
+	return os.path.join(config.TRANSCODE_PATH, f"{media_file_id}.mp4")
+
+def source_matches(path, size, mtime):
+	## A mezzanine is only good for the file it was made from. A source
+	## replaced in place keeps its path but not its size or mtime
+	try:
+		st = os.stat(path)
+	except OSError:
+		return False
+	return st.st_size == size and st.st_mtime == mtime
+
+class Transcoder:
+	def __init__(self, logger=None):
+		self._db = get_mysql_connection()
+		self._probe_cache = ProbeCache(self._db, logger=logger)
+		self._logger = logger
+
+		if config.TRANSCODE_PATH and not os.path.exists(config.TRANSCODE_PATH):
+			os.makedirs(config.TRANSCODE_PATH)
+
+		if logger is not None:
+			global _print
+			_print = logger._print
+
+	def close(self):
+		self._db.close()
+
+	def transcode_upcoming(self, hours=None):
+		if hours is None:
+			hours = config.TRANSCODE_AHEAD_HOURS
+		cur = self._db.cursor(dictionary=True)
+
+		## Soonest first so a short run still covers what airs next
+		now = datetime.now()
+		q = (
+			"SELECT schedule.media_file_id, media_files.path, "
+			"media_files.transcoded_size, media_files.transcoded_mtime, "
+			"MAX(tv_episodes.transcoded) AS transcoded, "
+			"MIN(schedule.start_time) AS first_start_time "
+			"FROM schedule "
+			"INNER JOIN tv_episodes "
+			"ON tv_episodes.media_file_id = schedule.media_file_id "
+			"INNER JOIN media_files "
+			"ON schedule.media_file_id = media_files.id "
+			"WHERE schedule.start_time > %s "
+			"AND schedule.start_time <= %s "
+			"GROUP BY schedule.media_file_id, media_files.path, "
+			"media_files.transcoded_size, media_files.transcoded_mtime "
+			"ORDER BY first_start_time"
+		)
+		cur.execute(q, (now, now + timedelta(hours=hours)))
+		pending = []
+		for f in cur.fetchall():
+			if not f['transcoded']:
+				pending.append(f)
+			elif not source_matches(f['path'], f['transcoded_size'], f['transcoded_mtime']):
+				## Stop the player using the old mezzanine straight away
+				_print(f"{f['path']} changed since it was transcoded", LOG_LEVEL_INFO)
+				self._set_transcoded(cur, f['media_file_id'], 0)
+				self._db.commit()
+				pending.append(f)
+		_print(f"{len(pending)} file(s) to transcode for the next {hours}h", LOG_LEVEL_INFO)
+
+		transcoded = 0
+		for f in pending:
+			try:
+				st = os.stat(f['path'])
+			except OSError:
+				_print(f"Cannot stat {f['path']}", LOG_LEVEL_ERROR)
+				continue
+			if not self.transcode(f['media_file_id'], f['path']):
+				continue
+
+			## Stat taken before encoding, so a change during the encode is
+			## caught next run
+			q = (
+				"UPDATE media_files "
+				"SET transcoded_size = %s, "
+				"transcoded_mtime = %s "
+				"WHERE id = %s"
+			)
+			cur.execute(q, (st.st_size, st.st_mtime, f['media_file_id']))
+			self._set_transcoded(cur, f['media_file_id'], 1)
+			self._db.commit()
+			transcoded += 1
+
+		cur.close()
+		return transcoded
+
+	def transcode(self, media_file_id, path):
+		output_file = mezzanine_path(media_file_id)
+		temp_file = f"{output_file}.tmp"
+
+		probe = self._probe_cache.get(path)
+		video_track = get_video_track(probe, path)
+		audio_track = get_audio_track(probe, path)
+
+		## Same normalization the player does live, so mezzanines can be
+		## stream copied back to back without the client noticing
+		encoder = get_backend(logger=self._logger)
+		ffmpeg_params = [
+			config.FFMPEG_PATH,
+			'-hide_banner',
+			'-y'
+		] + encoder.input_args() + [
+			'-i', path
+		]
+		filters = (
+			f'[0:{video_track}]scale=1920:1080:force_original_aspect_ratio=decrease[v],'
+			'[v]pad=1920:1080:(ow-iw)/2:(oh-ih)/2[v],'
+			'[v]setsar=1[v],'
+			'[v]format=yuv420p[v]'
+		)
+		if config.WATERMARK:
+			ffmpeg_params += ['-i', config.WATERMARK]
+			filters += (
+				',[1:v]format=rgba,colorchannelmixer=aa=0.5[overlay],'
+				'[v][overlay]overlay=(main_w-overlay_w)-30:(main_h-overlay_h)-30[v]'
+			)
+
+		ffmpeg_params += [
+			'-filter_complex', filters,
+			'-map', '[v]',
+			'-map', f"0:{audio_track}"
+		] + encoder.output_args() + [
+			'-pix_fmt', 'yuv420p',
+			'-r', '30000/1001',
+			'-g', '60',
+			'-c:a', 'aac',
+			'-ar', '44100',
+			'-b:a', "256k",
+			'-ac', "1",
+			'-movflags', '+faststart',
+			'-f', 'mp4',
+			temp_file
+		]
+
+		_print(f"Transcoding {path} to {output_file}", LOG_LEVEL_INFO)
+		process = subprocess.Popen(
+			ffmpeg_params,
+			stdout=subprocess.DEVNULL,
+			stderr=subprocess.DEVNULL
+		)
+		process.wait()
+		if process.returncode != 0:
+			_print(f"Transcode failed for {path} ({process.returncode})", LOG_LEVEL_ERROR)
+			if os.path.exists(temp_file):
+				os.remove(temp_file)
+			return False
+
+		os.replace(temp_file, output_file)
+		return True
+
+	def _set_transcoded(self, cur, media_file_id, transcoded):
+		q = (
+			"UPDATE tv_episodes "
+			"SET transcoded = %s "
+			"WHERE media_file_id = %s"
+		)
+		cur.execute(q, (transcoded, media_file_id))
+		self._bump_schedule_revision(cur)
+
+	def _bump_schedule_revision(self, cur):
+		## The schedule triggers don't see tv_episodes changes, so tell
+		## players to reload their lookahead window and pick up the flag
+		q = (
+			"UPDATE schedule_revision "
+			"SET revision = revision + 1 "
+			"WHERE id = 1"
+		)
+		cur.execute(q)
+
+	def cleanup(self):
+		cur = self._db.cursor(dictionary=True)
+
+		## Anything not airing any more can go
+		q = (
+			"SELECT DISTINCT media_file_id "
+			"FROM schedule "
+			"WHERE end_time >= %s "
+			"AND media_file_id IS NOT NULL"
+		)
+		cur.execute(q, (datetime.now(), ))
+		upcoming = set(r['media_file_id'] for r in cur.fetchall())
+
+		stale = []
+		for name in os.listdir(config.TRANSCODE_PATH):
+			media_file_id = name.split('.', 1)[0]
+			if not media_file_id.isdigit() or not name.endswith(('.mp4', '.tmp')):
+				continue
+			if int(media_file_id) in upcoming:
+				continue
+			os.remove(os.path.join(config.TRANSCODE_PATH, name))
+			stale.append(int(media_file_id))
+
+		_print(f"Removed {len(stale)} stale mezzanine file(s)", LOG_LEVEL_INFO)
+
+		if stale:
+			placeholders = ", ".join(["%s"] * len(stale))
+			q = (
+				"UPDATE tv_episodes "
+				"SET transcoded = 0 "
+				f"WHERE media_file_id IN ({placeholders})"
+			)
+			cur.execute(q, stale)
+			self._bump_schedule_revision(cur)
+			self._db.commit()
+
+		cur.close()
+		return len(stale)
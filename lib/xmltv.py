@@ -0,0 +1,73 @@
+from datetime import timedelta
+from xml.sax.saxutils import XMLGenerator
+import pytz
+
+class XMLTVWriter:
+	def __init__(self, f, timezone, indent="  "):
+		self._xml = XMLGenerator(f, encoding="utf-8", short_empty_elements=True)
+		self._tz = pytz.timezone(timezone)
+		self._indent = indent
+
+	def start(self):
+		self._xml.startDocument()
+		self._xml.startElement('tv', {})
+
+	def end(self):
+		self._newline(0)
+		self._xml.endElement('tv')
+		self._xml.characters("\n")
+		self._xml.endDocument()
+
+	def write_channel(self, channel_id, name, icon=None):
+		self._newline(1)
+		self._xml.startElement('channel', {'id': channel_id})
+		self._text_element(2, 'display-name', {}, name)
+		if icon:
+			self._empty_element(2, 'icon', {
+				'src': icon,
+				'width': "100",
+				'height': "100"
+			})
+		self._newline(1)
+		self._xml.endElement('channel')
+
+	def write_programme(self, s, channel_id):
+		start_aware = self._tz.localize(s['start_time'] + timedelta(seconds=30))
+		end_aware = self._tz.localize(s['end_time'] + timedelta(seconds=30))
+
+		self._newline(1)
+		self._xml.startElement('programme', {
+			'start': start_aware.strftime("%Y%m%d%H%M%S %z"),
+			'stop': end_aware.strftime("%Y%m%d%H%M%S %z"),
+			'channel': channel_id
+		})
+
+		description = s['description']
+		if description is None:
+			description = "No description"
+		self._text_element(2, 'title', {'lang': "en"}, s['title'])
+		self._text_element(2, 'desc', {'lang': "en"}, description)
+
+		if s['thumbnail'] and s['thumbnail_width'] and s['thumbnail_height']:
+			self._empty_element(2, 'icon', {
+				'src': s['thumbnail'],
+				'width': str(s['thumbnail_width']),
+				'height': str(s['thumbnail_height'])
+			})
+
+		self._newline(1)
+		self._xml.endElement('programme')
+
+	def _newline(self, depth):
+		self._xml.ignorableWhitespace("\n" + self._indent * depth)
+
+	def _text_element(self, depth, name, attrs, text):
+		self._newline(depth)
+		self._xml.startElement(name, attrs)
+		self._xml.characters(text or "")
+		self._xml.endElement(name)
+
+	def _empty_element(self, depth, name, attrs):
+		self._newline(depth)
+		self._xml.startElement(name, attrs)
+		self._xml.endElement(name)
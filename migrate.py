@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import argparse, sys
+
+from lib.migrations import MigrationRunner
+from lib.common import Logger, add_logger_args, get_logger_from_args
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument(
+		"--status",
+		help="Show applied and pending migrations",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--migrate",
+		help="Apply all pending migrations",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--dry-run",
+		help="Print pending migrations without applying them",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--check-plans",
+		help="EXPLAIN known hot queries and fail if any of them needs a full table scan",
+		action="store_true"
+	)
+	add_logger_args(parser)
+
+	args = parser.parse_args()
+	logger = get_logger_from_args(args)
+	_print = logger._print
+
+	runner = MigrationRunner(logger=logger)
+
+	did_something = False
+	exit_code = 0
+	if args.status:
+		runner.status()
+		did_something = True
+
+	if args.migrate:
+		_print("Applying migrations...")
+		runner.migrate(dry_run=args.dry_run)
+		_print("Done!")
+		did_something = True
+
+	if args.check_plans:
+		_print("Checking query plans...")
+		failures = runner.check_query_plans()
+		if failures:
+			_print(f"{len(failures)} hot query(s) fall back to a full scan: {', '.join(failures)}")
+			exit_code = 1
+		else:
+			_print("All hot queries use an index")
+		did_something = True
+
+	if not did_something:
+		print("Nothing to do!")
+		print(f"Use {sys.argv[0]} --help")
+
+	runner.close()
+	sys.exit(exit_code)
@@ -1,17 +1,30 @@
 #!/usr/bin/env python3
-import argparse
+import argparse, sys
 
-from lib.player import Player
+from lib.player import Player, Supervisor
+from lib.channels import get_channel
 from lib.common import Logger, add_logger_args, get_logger_from_args
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		"--channel",
+		help="Only play channel CHANNEL (id). Plays every channel by default",
+		type=int
+	)
 	add_logger_args(parser)
 
 	args = parser.parse_args()
 	logger = get_logger_from_args(args)
 	_print = logger._print
 
-	p = Player(logger=logger)
-	p.play()
-	p.close()
\ No newline at end of file
+	if args.channel is not None:
+		channel = get_channel(args.channel)
+		if channel is None:
+			print(f"No channel with id {args.channel}")
+			sys.exit(1)
+		p = Player(logger=logger, channel=channel)
+		p.play()
+		p.close()
+	else:
+		Supervisor(logger=logger).run()
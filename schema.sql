@@ -15,11 +15,24 @@ CREATE TABLE tv_shows (
 	PRIMARY KEY (id)
 );
 
+CREATE TABLE media_files (
+	id INT NOT NULL AUTO_INCREMENT,
+	path VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+	size BIGINT DEFAULT NULL,
+	mtime DOUBLE DEFAULT NULL,
+	probe_data MEDIUMTEXT DEFAULT NULL,
+	probed_at DATETIME DEFAULT NULL,
+	transcoded_size BIGINT DEFAULT NULL,
+	transcoded_mtime DOUBLE DEFAULT NULL,
+	PRIMARY KEY (id),
+	UNIQUE KEY idx_media_files_path (path)
+);
+
 CREATE TABLE tv_episodes (
 	id INT NOT NULL AUTO_INCREMENT,
 	tv_show_id INT NOT NULL,
 	tvdb_id VARCHAR(50),
-	path VARCHAR(255) NOT NULL,
+	media_file_id INT NOT NULL,
 	duration INT NOT NULL,
 	season_number INT NOT NULL,
 	episode_number INT NOT NULL,
@@ -27,9 +40,22 @@ CREATE TABLE tv_episodes (
 	needs_update TINYINT NOT NULL DEFAULT 0,
 	last_updated DATETIME DEFAULT NULL,
 	transcoded TINYINT NOT NULL DEFAULT 0,
-	PRIMARY KEY (id)
+	PRIMARY KEY (id),
+	CONSTRAINT fk_episode_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id)
+);
+CREATE INDEX idx_episode_media_file ON tv_episodes (media_file_id);
+CREATE INDEX idx_episode_show_order ON tv_episodes (tv_show_id, season_number, episode_number);
+
+CREATE TABLE tv_show_stats (
+	tv_show_id INT NOT NULL,
+	episode_count INT NOT NULL DEFAULT 0,
+	total_duration INT NOT NULL DEFAULT 0,
+	mean_duration INT NOT NULL DEFAULT 0,
+	max_duration INT NOT NULL DEFAULT 0,
+	last_updated DATETIME DEFAULT NULL,
+	PRIMARY KEY (tv_show_id)
 );
-CREATE INDEX idx_episode_path ON tv_episodes (path); 
+CREATE INDEX idx_show_stats_total_duration ON tv_show_stats (total_duration);
 
 CREATE TABLE movies (
 	id INT NOT NULL AUTO_INCREMENT,
@@ -51,10 +77,11 @@ CREATE TABLE movies (
 
 CREATE TABLE schedule (
 	id INT NOT NULL AUTO_INCREMENT,
+	channel_id INT NOT NULL DEFAULT 1,
 	--tv_episode_id INT NOT NULL,
 	title VARCHAR(255) DEFAULT NULL,
 	description TEXT DEFAULT NULL,
-	path VARCHAR(255) DEFAULT NULL,
+	media_file_id INT DEFAULT NULL,
 	tag VARCHAR(255) NOT NULL,
 	thumbnail VARCHAR(255) DEFAULT NULL,
 	thumbnail_width INT NOT NULL DEFAULT 0,
@@ -65,5 +92,76 @@ CREATE TABLE schedule (
 	actual_end_time DATETIME DEFAULT NULL,
 	completed TINYINT NOT NULL DEFAULT 0,
 	is_marathon TINYINT NOT NULL DEFAULT 0,
+	PRIMARY KEY (id),
+	CONSTRAINT fk_schedule_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id) ON DELETE SET NULL
+);
+CREATE INDEX idx_schedule_start_time ON schedule (start_time);
+CREATE INDEX idx_schedule_end_time ON schedule (end_time);
+CREATE INDEX idx_schedule_tag_start_time ON schedule (tag, start_time);
+CREATE INDEX idx_schedule_tag_end_time ON schedule (tag, end_time);
+CREATE INDEX idx_schedule_media_file ON schedule (media_file_id);
+CREATE INDEX idx_schedule_channel_start_time ON schedule (channel_id, start_time);
+CREATE INDEX idx_schedule_channel_end_time ON schedule (channel_id, end_time);
+CREATE INDEX idx_schedule_channel_tag_end_time ON schedule (channel_id, tag, end_time);
+
+CREATE TABLE schedule_revision (
+	id TINYINT NOT NULL,
+	revision BIGINT NOT NULL DEFAULT 0,
 	PRIMARY KEY (id)
-);
\ No newline at end of file
+);
+INSERT INTO schedule_revision (id, revision) VALUES (1, 0);
+CREATE TRIGGER trg_schedule_revision_insert AFTER INSERT ON schedule
+	FOR EACH ROW
+	UPDATE schedule_revision SET revision = revision + 1 WHERE id = 1;
+CREATE TRIGGER trg_schedule_revision_delete AFTER DELETE ON schedule
+	FOR EACH ROW
+	UPDATE schedule_revision SET revision = revision + 1 WHERE id = 1;
+CREATE TRIGGER trg_schedule_revision_update AFTER UPDATE ON schedule
+	FOR EACH ROW
+	UPDATE schedule_revision SET revision = revision + 1
+	WHERE id = 1
+	AND (NEW.start_time <> OLD.start_time
+		OR NEW.end_time <> OLD.end_time
+		OR NOT (NEW.media_file_id <=> OLD.media_file_id));
+
+CREATE TABLE playback_stats (
+	id INT NOT NULL AUTO_INCREMENT,
+	schedule_id INT DEFAULT NULL,
+	media_file_id INT DEFAULT NULL,
+	channel_id INT NOT NULL DEFAULT 1,
+	encoder VARCHAR(32) DEFAULT NULL,
+	started_at DATETIME NOT NULL,
+	ended_at DATETIME NOT NULL,
+	frames INT NOT NULL DEFAULT 0,
+	out_time DOUBLE NOT NULL DEFAULT 0,
+	avg_fps DOUBLE DEFAULT NULL,
+	avg_speed DOUBLE DEFAULT NULL,
+	min_speed DOUBLE DEFAULT NULL,
+	slow_samples INT NOT NULL DEFAULT 0,
+	dropped_frames INT NOT NULL DEFAULT 0,
+	duplicated_frames INT NOT NULL DEFAULT 0,
+	avg_bitrate DOUBLE DEFAULT NULL,
+	PRIMARY KEY (id),
+	CONSTRAINT fk_playback_stats_schedule FOREIGN KEY (schedule_id) REFERENCES schedule (id) ON DELETE SET NULL,
+	CONSTRAINT fk_playback_stats_media_file FOREIGN KEY (media_file_id) REFERENCES media_files (id) ON DELETE SET NULL
+);
+CREATE INDEX idx_playback_stats_media_file ON playback_stats (media_file_id);
+CREATE INDEX idx_playback_stats_started_at ON playback_stats (started_at);
+
+CREATE TABLE schema_version (
+	version INT NOT NULL,
+	description VARCHAR(255) NOT NULL,
+	applied_at DATETIME NOT NULL,
+	PRIMARY KEY (version)
+);
+INSERT INTO schema_version (version, description, applied_at) VALUES
+	(1, 'Add schedule indexes for player, scheduler and intermission queries', NOW()),
+	(2, 'Add episode ordering index', NOW()),
+	(3, 'Add tv_show_stats table', NOW()),
+	(4, 'Move media file paths into media_files', NOW()),
+	(5, 'Cache ffprobe output on media_files', NOW()),
+	(6, 'Track schedule revisions for the player lookahead', NOW()),
+	(7, 'Add channel_id to schedule', NOW()),
+	(8, 'Add playback_stats table', NOW()),
+	(9, 'Record the source each mezzanine was made from', NOW()),
+	(10, 'Compare media file paths byte for byte', NOW());
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import argparse, sys
+
+from lib.transcoder import Transcoder
+from lib.common import Logger, add_logger_args, get_logger_from_args
+import config
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+
+	parser.add_argument(
+		"--transcode-upcoming",
+		help="Transcode scheduled episodes airing soon into normalized mezzanine files",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--hours",
+		help="How far ahead to transcode. Defaults to TRANSCODE_AHEAD_HOURS",
+		type=int
+	)
+	parser.add_argument(
+		"--cleanup-old",
+		help="Remove mezzanine files that are no longer scheduled",
+		action="store_true"
+	)
+
+	add_logger_args(parser)
+
+	args = parser.parse_args()
+	logger = get_logger_from_args(args)
+	_print = logger._print
+
+	if not config.TRANSCODE_PATH:
+		print("TRANSCODE_PATH is not set in config.py")
+		sys.exit(1)
+
+	transcoder = Transcoder(logger=logger)
+
+	did_something = False
+
+	if args.transcode_upcoming:
+		_print("Transcoding upcoming episodes...")
+		transcoder.transcode_upcoming(hours=args.hours)
+		_print("Done!")
+		did_something = True
+
+	if args.cleanup_old:
+		_print("Cleaning up old mezzanine files...")
+		transcoder.cleanup()
+		_print("Done!")
+		did_something = True
+
+	if not did_something:
+		print("Nothing to do!")
+		print(f"Use {sys.argv[0]} --help")
+
+	transcoder.close()